@@ -1,7 +1,20 @@
 import os
+import gc
+import glob
 import json
+import argparse
+import time
+import struct
 import random
 import math
+import bisect
+import collections
+import queue
+import socket
+import selectors
+import weakref
+import threading
+import traceback
 import pygame
 
 class Path:
@@ -57,13 +70,96 @@ class Background:
         pass
 
 
+class Renderer:
+    # Draws at the logical resolution times render_scale, the window gets one scaled copy per frame
+    def __init__(self, config: Config, headless: bool = False) -> None:
+        self.config = config
+
+        screen = self.config.config['screen']
+        self.logical_size = (screen['width'], screen['height'])
+        self.smooth = screen['smooth_scaling']  # Filter for the whole frame, costly on large windows
+        if headless:
+            self.display = pygame.display.set_mode(self.logical_size)
+        elif screen['fullscreen']:
+            self.display = pygame.display.set_mode((0, 0), pygame.FULLSCREEN)
+        else:
+            self.display = pygame.display.set_mode((screen['window_width'], screen['window_height']))
+
+        # Largest area with the logical aspect ratio, centered in the window
+        display_width, display_height = self.display.get_size()
+        fit = min(display_width / self.logical_size[0], display_height / self.logical_size[1])
+        self.viewport = pygame.Rect(0, 0, round(self.logical_size[0] * fit), round(self.logical_size[1] * fit))
+        self.viewport.center = (display_width // 2, display_height // 2)
+
+        self.variants = {}  # Scaled assets per scale factor, dropped together with their source surface
+        self.set_scale(screen['render_scale'])
+
+    def set_scale(self, scale: float) -> None:
+        self.scale = scale
+        self.cache = self.variants.setdefault(scale, weakref.WeakKeyDictionary())
+
+        size = (max(1, round(self.logical_size[0] * scale)), max(1, round(self.logical_size[1] * scale)))
+        if size == self.display.get_size():
+            self.surface = self.display  # Nothing to scale, draw straight into the window
+        else:
+            self.surface = pygame.Surface(size).convert()
+            self.display.fill((0, 0, 0))
+        self.target = self.display.subsurface(self.viewport)
+
+    def variant(self, image: pygame.Surface) -> pygame.Surface:
+        scaled = self.cache.get(image)
+        if scaled is None:
+            width, height = image.get_size()
+            size = (max(1, round(width * self.scale)), max(1, round(height * self.scale)))
+            if image.get_bitsize() in (24, 32):  # Built once, so the better filter is affordable
+                scaled = pygame.transform.smoothscale(image, size)
+            else:
+                scaled = pygame.transform.scale(image, size)
+            self.cache[image] = scaled
+        return scaled
+
+    def scaled(self, blit: tuple) -> tuple:
+        # (source, dest, area, special_flags) in logical coordinates to the internal surface
+        source, dest, *rest = blit
+        dest = (round(dest[0] * self.scale), round(dest[1] * self.scale))
+        if rest and rest[0] is not None:
+            area = pygame.Rect(rest[0])
+            rest[0] = pygame.Rect(round(area.x * self.scale), round(area.y * self.scale),
+                                  round(area.width * self.scale), round(area.height * self.scale))
+        return (self.variant(source), dest, *rest)
+
+    def blit(self, source: pygame.Surface, dest, area=None, special_flags: int = 0) -> pygame.Rect:
+        if self.scale == 1:
+            return self.surface.blit(source, dest, area, special_flags)
+        return self.surface.blit(*self.scaled((source, dest, area, special_flags)))
+
+    def blits(self, sequence, doreturn: bool = True):
+        if self.scale == 1:
+            return self.surface.blits(sequence, doreturn)
+        return self.surface.blits((self.scaled(blit) for blit in sequence), doreturn)
+
+    def present(self) -> None:
+        if self.surface is not self.display:
+            if self.smooth:
+                pygame.transform.smoothscale(self.surface, self.viewport.size, self.target)
+            else:
+                pygame.transform.scale(self.surface, self.viewport.size, self.target)
+        pygame.display.flip()
+
+    def to_logical(self, position) -> tuple:
+        # Window coordinates, e.g. of the mouse, to the coordinates the game simulates in
+        return ((position[0] - self.viewport.x) * self.logical_size[0] / self.viewport.width,
+                (position[1] - self.viewport.y) * self.logical_size[1] / self.viewport.height)
+
+
 class Button(pygame.sprite.Sprite):
     def __init__(self, config: Config, width: int, height: int, x: int | None, y: int, text: str,
                  color: tuple = (0, 0, 0), font: tuple | pygame.font.Font = ('arial', 24), click_callback=None,
-                 state=None) -> None:
+                 state=None, game=None) -> None:
         super().__init__()
 
         self.config = config
+        self.game = game
 
         self.image_selected = pygame.image.load(
             os.path.join(Path.assets_images_path, config.config['images']['menu_item_selected'])).convert_alpha()
@@ -104,7 +200,7 @@ class Button(pygame.sprite.Sprite):
 
     def update(self) -> None:
         old_hovered = self.hovered
-        self.hovered = self.rect.collidepoint(pygame.mouse.get_pos())
+        self.hovered = self.rect.collidepoint(self.game.renderer.to_logical(pygame.mouse.get_pos()))
 
         if self.hovered != old_hovered:
             self.image = self.image_selected if self.hovered else self.image_unselected
@@ -113,81 +209,595 @@ class Button(pygame.sprite.Sprite):
         screen.blit(self.image, self.rect)
         screen.blit(self.text, self.text_rect)
 
-    def trigger_click(self):
-        if self.hovered and isinstance(game.state, self.state):
+    def trigger_click(self) -> bool:
+        if self.hovered and isinstance(self.game.state, self.state):
             self.click_callback()
+            return True
+        return False
 
 
 class Timer(object):
     # Credits: https://github.com/adamsralf/pygame_timecontrol
 
-    def __init__(self, duration, with_start=True):
+    def __init__(self, duration, with_start=True, clock=pygame.time.get_ticks):
         self.duration = duration
+        self.clock = clock
         if with_start:
-            self.next = pygame.time.get_ticks()
+            self.next = self.clock()
         else:
-            self.next = pygame.time.get_ticks() + self.duration
+            self.next = self.clock() + self.duration
 
     def is_next_stop_reached(self):
-        if pygame.time.get_ticks() > self.next:
-            self.next = pygame.time.get_ticks() + self.duration
+        if self.clock() > self.next:
+            self.next = self.clock() + self.duration
             return True
         return False
 
 
-class Game:
+class InputHandler:
     def __init__(self, config: Config) -> None:
-        pygame.init()
+        self.config = config
 
+        self.allowed_events = [getattr(pygame, name) for name in self.config.config['input']['allowed_events']]
+        pygame.event.set_blocked(None)
+        pygame.event.set_allowed(self.allowed_events)
+
+        self.last_poll = time.perf_counter()
+        self.pending_inputs = []  # Timestamps of inputs which are not on screen yet
+        self.stepped_inputs = collections.deque()  # Simulation step and timestamp of inputs handled by the thread
+        self.latencies = collections.deque(maxlen=self.config.config['input']['latency_samples'])
+
+    def poll(self) -> list:
+        # Events carry no timestamp, so the previous poll is the earliest an unseen event could have been queued
+        events = pygame.event.get()
+        if events:
+            self.pending_inputs.append(self.last_poll)
+        self.last_poll = time.perf_counter()
+        return events
+
+    def presented(self, step: int | None = None) -> None:
+        # With a simulation thread, inputs are on screen once a frame of the step which handled them is
+        now = time.perf_counter()
+        while step is not None and self.stepped_inputs and self.stepped_inputs[0][0] <= step:
+            self.latencies.append((now - self.stepped_inputs.popleft()[1]) * 1000)
+
+        for timestamp in self.pending_inputs:
+            self.latencies.append((now - timestamp) * 1000)
+        self.pending_inputs.clear()
+
+    def report(self) -> dict:
+        if not self.latencies:
+            return {'samples': 0, 'mean_ms': 0, 'p95_ms': 0, 'max_ms': 0}
+
+        latencies = sorted(self.latencies)
+        return {
+            'samples': len(latencies),
+            'mean_ms': round(sum(latencies) / len(latencies), 2),
+            'p95_ms': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 2),
+            'max_ms': round(latencies[-1], 2)
+        }
+
+
+class Telemetry:
+    # Records gameplay and performance events into a ring buffer, a background thread writes them to
+    # rotating newline delimited JSON files
+    def __init__(self, config: Config, enabled: bool = True) -> None:
         self.config = config
-        self.screen = pygame.display.set_mode(
-            (self.config.config['screen']['width'], self.config.config['screen']['height']))
-        pygame.display.set_caption(self.config.config['screen']['title'])
+        self.settings = self.config.config['telemetry']
+        self.enabled = enabled
+
+        self.buffer = collections.deque(maxlen=self.settings['buffer_size'])
+        self.dropped = 0
+
+        self.directory = os.path.join(Path.runtime_path, self.settings['directory'])
+        self.session = time.strftime('%Y%m%d-%H%M%S')
+        self.file_index = 0
+        self.file = None
+
+        self.stop_event = threading.Event()
+        self.writer = None
+        if self.enabled:
+            os.makedirs(self.directory, exist_ok=True)
+            self.writer = threading.Thread(target=self.write_loop, daemon=True)
+            self.writer.start()
+
+    def record(self, kind: str, **fields) -> None:
+        if not self.enabled:
+            return
+        if len(self.buffer) == self.buffer.maxlen:
+            self.dropped += 1
+        self.buffer.append((time.time(), kind, fields))
+
+    def write_loop(self) -> None:
+        while not self.stop_event.wait(self.settings['flush_interval']):
+            self.flush()
+
+    def flush(self) -> None:
+        if not self.buffer:
+            return
+
+        lines = []
+        while self.buffer:
+            timestamp, kind, fields = self.buffer.popleft()
+            lines.append(json.dumps({'time': timestamp, 'kind': kind, **fields}))
+        if self.dropped:
+            lines.append(json.dumps({'time': time.time(), 'kind': 'dropped', 'count': self.dropped}))
+            self.dropped = 0
+
+        self.open_file()
+        self.file.write('\n'.join(lines) + '\n')
+        self.file.flush()
+
+    def open_file(self) -> None:
+        if self.file is not None and self.file.tell() < self.settings['max_file_bytes']:
+            return
+
+        if self.file is not None:
+            self.file.close()
+            self.file_index += 1
+        self.file = open(os.path.join(self.directory, f'telemetry-{self.session}-{self.file_index:04d}.ndjson'), 'a')
+
+        # Rotate, only the newest files are kept
+        files = sorted(glob.glob(os.path.join(self.directory, 'telemetry-*.ndjson')))
+        for old_file in files[:-self.settings['max_files']]:
+            os.remove(old_file)
+
+    def close(self) -> None:
+        if not self.enabled:
+            return
+
+        self.enabled = False
+        self.stop_event.set()
+        self.writer.join()
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+
+    @staticmethod
+    def percentile(values: list, fraction: float) -> float:
+        if not values:
+            return 0
+        return values[min(len(values) - 1, int(len(values) * fraction))]
+
+    @staticmethod
+    def analyze(directory: str) -> dict:
+        counts = collections.Counter()
+        spawns = collections.Counter()
+        bounces = collections.Counter()
+        kills = collections.Counter()
+        deaths = collections.Counter()
+        points = []
+        frames = []
+        gc_pauses = []
+
+        for file_name in sorted(glob.glob(os.path.join(directory, 'telemetry-*.ndjson'))):
+            with open(file_name, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # Partially written line after a crash
+
+                    kind = record['kind']
+                    counts[kind] += 1
+                    if kind == 'spawn':
+                        spawns[record['entity']] += 1
+                    elif kind == 'bounce':
+                        bounces[record['platform']] += 1
+                    elif kind == 'kill':
+                        kills[record['monster']] += 1
+                    elif kind == 'death':
+                        deaths[record['cause']] += 1
+                        points.append(record['points'])
+                    elif kind == 'frame':
+                        frames.append(record['ms'])
+                    elif kind == 'gc':
+                        gc_pauses.append(record['ms'])
+
+        frames.sort()
+        gc_pauses.sort()
+        return {
+            'runs': counts['run'],
+            'deaths': dict(deaths),
+            'mean_points': round(sum(points) / len(points), 2) if points else 0,
+            'max_points': round(max(points), 2) if points else 0,
+            'spawns': dict(spawns),
+            'bounces': dict(bounces),
+            'kills': dict(kills),
+            'frames': len(frames),
+            'frame_ms': {'p50': round(Telemetry.percentile(frames, 0.5), 3),
+                         'p95': round(Telemetry.percentile(frames, 0.95), 3),
+                         'p99': round(Telemetry.percentile(frames, 0.99), 3)},
+            'gc_pauses': len(gc_pauses),
+            'gc_ms': {'total': round(sum(gc_pauses), 3), 'max': round(gc_pauses[-1], 3) if gc_pauses else 0},
+            'dropped': counts['dropped']
+        }
+
+
+class GCManager:
+    # Keeps automatic collections out of gameplay frames, they run in idle frame time and on state transitions
+    def __init__(self, config: Config, telemetry: Telemetry, enabled: bool = True, measured: bool = True) -> None:
+        self.config = config
+        self.settings = self.config.config['gc']
+        self.telemetry = telemetry
+        self.enabled = enabled
+
+        self.frame_time = 1000 / self.config.config['screen']['fps']
+        self.histogram = [0] * (len(self.settings['histogram_buckets']) + 1)  # Upper bounds in ms, last is overflow
+        self.generations = [0, 0, 0]
+        self.max_pause = 0
+        self.gc_start = None
+        # The one gc callback of a game, its pauses also feed the telemetry
+        self.measuring = measured and (self.enabled or self.settings['report'] or self.telemetry.enabled)
+        if self.measuring:
+            gc.callbacks.append(self.gc_callback)
+
+    def gc_callback(self, phase: str, info: dict) -> None:
+        if phase == 'start':
+            self.gc_start = time.perf_counter()
+            return
+        if self.gc_start is None:
+            return
+
+        pause = (time.perf_counter() - self.gc_start) * 1000
+        self.gc_start = None
+        self.histogram[bisect.bisect_left(self.settings['histogram_buckets'], pause)] += 1
+        self.generations[info['generation']] += 1
+        self.max_pause = max(self.max_pause, pause)
+        self.telemetry.record('gc', ms=pause, generation=info['generation'], collected=info['collected'])
+
+    def freeze(self) -> None:
+        # Everything loaded so far lives until exit, keep it out of future collections
+        if self.enabled:
+            gc.collect()
+            gc.freeze()
+
+    def state_changed(self, state) -> None:
+        if not self.enabled:
+            return
+
+        gc.collect()
+        if isinstance(state, MainGameState):
+            gc.disable()
+        else:
+            gc.enable()
+
+    def idle(self, frame_cost: float) -> None:
+        if not self.enabled or gc.isenabled():
+            return
+
+        counts = gc.get_count()
+        thresholds = gc.get_threshold()
+        # Without idle time the young generation is still bounded, only later than usual
+        if self.frame_time - frame_cost < self.settings['idle_threshold_ms'] and \
+                counts[0] < thresholds[0] * self.settings['max_deferral']:
+            return
+
+        if counts[1] > thresholds[1]:
+            gc.collect(1)
+        elif counts[0] > thresholds[0]:
+            gc.collect(0)
+
+    def close(self) -> None:
+        if self.measuring:
+            gc.callbacks.remove(self.gc_callback)
+        if self.enabled:
+            gc.enable()
+            gc.unfreeze()
+
+    def report(self) -> dict:
+        buckets = self.settings['histogram_buckets']
+        histogram = {f'<={bucket}ms': count for bucket, count in zip(buckets, self.histogram)}
+        histogram[f'>{buckets[-1]}ms'] = self.histogram[-1]
+        return {
+            'collections': sum(self.generations),
+            'generations': self.generations,
+            'max_ms': round(self.max_pause, 3),
+            'histogram': histogram
+        }
+
+
+class FrameBuffer:
+    # Double buffer of immutable frames, written by the simulation and read by the render thread
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.frames = [None, None]
+        self.sequences = [0, 0]
+        self.steps = [0, 0]  # Simulation step each frame was captured after
+        self.front = 0
+        self.rendered_step = 0
+
+        self.published = 0
+        self.rendered = 0
+        self.dropped = 0  # Published frames which were never rendered
+        self.duplicated = 0  # Renders which showed the same frame again
+
+    def publish(self, frame: tuple, step: int) -> None:
+        # The back slot is never read, it only has to be swapped in
+        back = 1 - self.front
+        self.frames[back] = frame
+        self.steps[back] = step
+        with self.lock:
+            self.published += 1
+            self.sequences[back] = self.published
+            self.front = back
+
+    def consume(self) -> tuple | None:
+        with self.lock:
+            frame = self.frames[self.front]
+            sequence = self.sequences[self.front]
+            self.rendered_step = self.steps[self.front]
+
+        if sequence == self.rendered:
+            self.duplicated += 1
+        elif self.rendered:
+            self.dropped += sequence - self.rendered - 1
+        self.rendered = sequence
+        return frame
+
+
+class SimulationThread(threading.Thread):
+    # Runs MainGameState at a fixed rate, input events are forwarded through a queue
+    def __init__(self, config: Config, game) -> None:
+        super().__init__(daemon=True)
+        self.config = config
+        self.game = game
+
+        self.events = queue.Queue()
+        self.frames = FrameBuffer()
+        self.step_time = 1000 / self.config.config['simulation']['rate']
+        self.running = True
+
+        self.steps = 0
+        self.queue_depth_total = 0
+        self.max_queue_depth = 0
+
+    def run(self) -> None:
+        try:
+            self.simulate()
+        except Exception:
+            # A dead simulation would freeze the screen on its last frame, the game stops instead
+            traceback.print_exc()
+            self.game.running = False
+
+    def simulate(self) -> None:
+        next_step = time.perf_counter()
+
+        while self.running:
+            queue_depth = self.events.qsize()
+            self.queue_depth_total += queue_depth
+            self.max_queue_depth = max(self.max_queue_depth, queue_depth)
+
+            with self.game.state_lock:
+                state = self.game.state
+                inputs = []  # Poll timestamps, forwarded after the events they belong to
+                for _ in range(queue_depth):
+                    event = self.events.get_nowait()
+                    if isinstance(event, float):
+                        inputs.append(event)
+                    elif self.game.state is state:
+                        state.handle_events(event)
+
+                published = False
+                if isinstance(self.game.state, MainGameState):
+                    self.game.delta_time = self.step_time
+                    self.game.update()
+                    self.steps += 1
+
+                    if self.game.state is state:
+                        self.frames.publish(state.capture(), self.steps)
+                        published = True
+
+                # Without a frame of this step the inputs show up in whatever the main thread draws next
+                if published:
+                    self.game.input.stepped_inputs.extend((self.steps, timestamp) for timestamp in inputs)
+                else:
+                    self.game.input.pending_inputs.extend(inputs)
+
+            next_step += self.step_time / 1000
+            delay = next_step - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -self.step_time / 1000 * 5:
+                next_step = time.perf_counter()  # Too far behind, skip instead of catching up
+
+    def stop(self) -> None:
+        self.running = False
+        self.join()
+
+    def report(self) -> dict:
+        return {
+            'steps': self.steps,
+            'mean_queue_depth': round(self.queue_depth_total / max(1, self.steps), 3),
+            'max_queue_depth': self.max_queue_depth,
+            'dropped_frames': self.frames.dropped,
+            'duplicated_frames': self.frames.duplicated
+        }
+
+
+class Game:
+    def __init__(self, config: Config, headless: bool = False, shared=None) -> None:
+        # Headless games are driven programmatically, they never show a window, play sounds or write files.
+        # A game created with shared is headless and borrows its display and loaded assets, it only brings
+        # its own states and clock, so many can run side by side cheaply.
+        self.headless = headless or shared is not None
+        if self.headless:
+            os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+            os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+        self.config = config
+        if shared is None:
+            pygame.init()
+            self.renderer = Renderer(config, headless=self.headless)
+            pygame.display.set_caption(self.config.config['screen']['title'])
+        else:
+            self.renderer = shared.renderer
         self.clock = pygame.time.Clock()
         self.running = True
         self.delta_time = 1.0 / self.config.config['screen']['fps']
+        self.frame_cost = 0  # Time in ms spent on events, update and draw in the last frame
+        self.ticks = 0  # Simulated time in ms, advanced by delta_time every update
+
+        # The simulation thread and the main thread never touch the states at the same time
+        self.state_lock = threading.RLock()
+        self.simulation = None
+        if shared is None:
+            self.sounds = {}
+            self.telemetry = Telemetry(config, enabled=self.config.config['telemetry']['enabled'] and not self.headless)
+            self.gc_manager = GCManager(config, self.telemetry, measured=not self.headless,
+                                        enabled=self.config.config['gc']['managed'] and not self.headless)
+            self.snapshots = SnapshotWriter(enabled=not self.headless)
+            self.background = Background(config)
+            self.input = InputHandler(config)
+            self.font = pygame.font.Font(os.path.join(Path.assets_fonts_path, 'al-seana.ttf'), 30)
+            self.highscore = Highscore(config)
+        else:
+            self.sounds = shared.sounds
+            self.telemetry = shared.telemetry
+            self.gc_manager = shared.gc_manager
+            self.snapshots = shared.snapshots
+            self.background = shared.background
+            self.input = shared.input
+            self.font = shared.font
+            self.highscore = shared.highscore
+
+        self.states = StateManager(config, self)
+        if shared is None:
+            self.states.switch(StartState)
+        else:
+            # Game over is only ever entered, never drawn, so one instance serves every game sharing it
+            self.states.cache[GameOverGameState] = shared.states.get(GameOverGameState)
 
-        self.background = Background(config)
-        self.buttons = pygame.sprite.Group()
-
-        self.state = StartState(self.config, self)
+        self.volume = self.config.config['sounds']['volume']
+        if self.headless:
+            self.background_music = None
+            return
 
         self.background_music = pygame.mixer.Sound(os.path.join(Path.assets_sounds_path, self.config.config['sounds']['background']))
-        self.volume = self.config.config['sounds']['volume']
         pygame.mixer.Channel(0).set_volume(self.volume)
         pygame.mixer.Channel(0).play(self.background_music, loops=-1)
 
+    def get_ticks(self) -> float:
+        return self.ticks
+
+    def play_sound(self, name: str) -> None:
+        if self.headless:
+            return
+
+        sound = self.sounds.get(name)
+        if sound is None:
+            sound = self.sounds[name] = pygame.mixer.Sound(
+                os.path.join(Path.assets_sounds_path, self.config.config['sounds'][name]))
+        sound.play()
+
     def run(self) -> None:
+        self.resume_savegame()
+        self.gc_manager.freeze()
+
+        if self.config.config['simulation']['threaded']:
+            self.simulation = SimulationThread(self.config, self)
+            self.simulation.start()
+
         while self.running:
-            self.events()
-            self.update()
+            frame_start = time.perf_counter()
+            with self.state_lock:
+                self.events()
+                if not self.simulated():
+                    self.update()
             self.draw()
-            self.delta_time = self.clock.tick(self.config.config['screen']['fps'])
+            self.frame_cost = (time.perf_counter() - frame_start) * 1000
+            self.telemetry.record('frame', ms=self.frame_cost)
+            self.gc_manager.idle(self.frame_cost)
+            delta_time = self.clock.tick(self.config.config['screen']['fps'])
+            if not self.simulated():
+                self.delta_time = delta_time
+
+        if self.simulation is not None:
+            self.simulation.stop()
+            if self.config.config['simulation']['report_metrics']:
+                print(f'Simulation: {self.simulation.report()}')
+
+        if self.config.config['input']['report_latency']:
+            print(f'Input latency: {self.input.report()}')
+
+        if self.config.config['gc']['report']:
+            print(f'GC pauses: {self.gc_manager.report()}')
+
+        self.gc_manager.close()
+        self.telemetry.close()
+        self.snapshots.close()
+
+    def simulated(self) -> bool:
+        return self.simulation is not None and isinstance(self.state, MainGameState)
+
+    def resume_savegame(self) -> None:
+        # Continue an interrupted run in the pause menu
+        savegame_file = os.path.join(Path.runtime_path, self.config.config['savegame']['file'])
+        snapshot = Snapshot.read(savegame_file)
+        if snapshot is None:
+            return
+
+        try:
+            self.states.switch(MainGameState, snapshot=snapshot)
+            self.states.push(PauseGameState, points=self.state.points)
+        except (ValueError, IndexError, struct.error) as e:
+            print(e)
+            self.snapshots.remove(savegame_file)
+            self.states.switch(StartState)
+
+    @property
+    def state(self):
+        return self.states.top
 
     def events(self) -> None:
-        for event in pygame.event.get():
-            self.state.handle_events(event)
+        forwarded = False
+        for event in self.input.poll():
+            state = self.state
+            if self.simulated() and event.type != pygame.QUIT:
+                self.simulation.events.put(event)
+                forwarded = True
+                continue
+            state.handle_events(event)
 
             if event.type == pygame.QUIT:
                 self.running = False
             if event.type == pygame.MOUSEBUTTONDOWN:
                 if event.button == 1:
-                    [button.trigger_click() for button in self.buttons]
+                    state.click_buttons()
+
+        if forwarded:
+            # The latency is measured once the simulation thread handled them and their frame was drawn
+            for timestamp in self.input.pending_inputs:
+                self.simulation.events.put(timestamp)
+            self.input.pending_inputs.clear()
 
     def update(self) -> None:
+        self.ticks += self.delta_time
         self.background.update()
         self.state.update()
 
     def draw(self) -> None:
-        self.background.draw(self.screen)
-        self.state.draw(self.screen)
-        pygame.display.flip()
+        self.background.draw(self.renderer)
+        with self.state_lock:
+            simulated = self.simulated()
+            if not simulated:
+                self.state.draw(self.renderer)
+        step = None
+        if simulated:
+            frame = self.simulation.frames.consume()
+            if frame is not None:
+                self.renderer.blits(frame, False)
+                step = self.simulation.frames.rendered_step
+        self.renderer.present()
+        with self.state_lock:
+            self.input.presented(step)  # The simulation thread hands its inputs over under the same lock
 
 
 class GameState:
     def __init__(self, config: Config, game: Game) -> None:
         self.config = config
         self.game = game
+        self.buttons = pygame.sprite.Group()  # Only buttons of the active state receive clicks
 
     def draw(self, screen: pygame.Surface) -> None:
         pass
@@ -198,6 +808,61 @@ class GameState:
     def handle_events(self, event) -> None:
         pass
 
+    def click_buttons(self) -> None:
+        for button in self.buttons.sprites():
+            if button.trigger_click():
+                break
+
+    def enter(self, **kwargs) -> None:
+        # Called whenever the state is pushed, states are cached and reused between entries
+        pass
+
+    def resume(self) -> None:
+        # Called when the state above this one was popped
+        pass
+
+    def exit(self) -> None:
+        pass
+
+
+class StateManager:
+    def __init__(self, config: Config, game: Game) -> None:
+        self.config = config
+        self.game = game
+
+        self.stack = []
+        self.cache = {}
+
+    @property
+    def top(self) -> GameState | None:
+        return self.stack[-1] if self.stack else None
+
+    def get(self, state_class) -> GameState:
+        state = self.cache.get(state_class)
+        if state is None:
+            state = self.cache[state_class] = state_class(self.config, self.game)
+        return state
+
+    def push(self, state_class, **kwargs) -> GameState:
+        state = self.get(state_class)
+        self.stack.append(state)
+        state.enter(**kwargs)
+        self.game.gc_manager.state_changed(state)
+        return state
+
+    def pop(self) -> GameState:
+        state = self.stack.pop()
+        state.exit()
+        if self.stack:
+            self.stack[-1].resume()
+        self.game.gc_manager.state_changed(self.top)
+        return state
+
+    def switch(self, state_class, **kwargs) -> GameState:
+        while self.stack:
+            self.stack.pop().exit()
+        return self.push(state_class, **kwargs)
+
 
 class StartState(GameState):
     def __init__(self, config: Config, game: Game) -> None:
@@ -224,29 +889,25 @@ class StartState(GameState):
         self.start_button = Button(config, 250, 50, None,
                                    self.logo_rect.bottom + self.config.config['start_screen']['play_button'][
                                        'logo_margin_top'], 'Start Game', (0, 0, 0),
-                                   pygame.font.Font(os.path.join(Path.assets_fonts_path, 'al-seana.ttf'), 30),
-                                   self.start_game, StartState)
+                                   self.game.font,
+                                   self.start_game, StartState, self.game)
         self.quit_button = Button(config, 250, 50, None,
                                   self.start_button.rect.bottom + self.config.config['start_screen']['quit_button'][
                                       'play_margin_top'], 'Quit', (0, 0, 0),
-                                  pygame.font.Font(os.path.join(Path.assets_fonts_path, 'al-seana.ttf'), 30),
-                                  self.stop_game, StartState)
+                                  self.game.font,
+                                  self.stop_game, StartState, self.game)
         self.music_button = Button(config, 250, 50, None,
                                   self.quit_button.rect.bottom + self.config.config['start_screen']['music_button'][
                                       'quit_margin_top'], 'Toggle Music', (0, 0, 0),
-                                  pygame.font.Font(os.path.join(Path.assets_fonts_path, 'al-seana.ttf'), 30),
-                                  self.toggle_music, StartState)
+                                  self.game.font,
+                                  self.toggle_music, StartState, self.game)
 
-        game.buttons.add(self.start_button)
-        game.buttons.add(self.quit_button)
-        game.buttons.add(self.music_button)
+        self.buttons.add(self.start_button, self.quit_button, self.music_button)
 
-        font = pygame.font.Font(os.path.join(Path.assets_fonts_path, 'al-seana.ttf'), 30)
-    
-        highscore_obj = Highscore(config)
-        highscore = highscore_obj.load_highscore()
+    def enter(self, **kwargs) -> None:
+        highscore = self.game.highscore.load_highscore()
 
-        self.highscore_text = font.render(f'Highscore: {round(highscore)}', True, (0, 0, 0))
+        self.highscore_text = self.game.font.render(f'Highscore: {round(highscore)}', True, (0, 0, 0))
         self.highscore_text_rect = self.highscore_text.get_rect()
         self.highscore_text_rect.centerx = self.config.config['screen']['width'] / 2
         self.highscore_text_rect.centery = self.music_button.rect.bottom + 100
@@ -264,7 +925,7 @@ class StartState(GameState):
         self.music_button.update()
 
     def start_game(self) -> None:
-        game.state = MainGameState(self.config, game)
+        self.game.states.switch(MainGameState)
 
     def stop_game(self) -> None:
         self.game.running = False
@@ -275,173 +936,298 @@ class StartState(GameState):
         else:
             pygame.mixer.Channel(0).play(self.game.background_music, loops=-1)
 
-class Monster(pygame.sprite.Sprite):
+
+class CollisionShape:
+    # Mask with its tight bounding box, shared by every sprite with the same image and size
+    _cache = {}
+
+    def __init__(self, mask: pygame.mask.Mask) -> None:
+        self.mask = mask
+
+        rects = self.mask.get_bounding_rects()
+        self.bounds = rects[0].unionall(rects[1:]) if rects else pygame.Rect(0, 0, 0, 0)
+        self.x, self.y, self.width, self.height = self.bounds
+        self.solid = self.mask.count() == self.width * self.height  # Bounds test alone is exact
+
+    @classmethod
+    def get(cls, key: tuple, surface: pygame.Surface):
+        shape = cls._cache.get(key)
+        if shape is None:
+            shape = cls._cache[key] = CollisionShape(pygame.mask.from_surface(surface))
+        return shape
+
+    @staticmethod
+    def overlap(left, left_shape, right, right_shape) -> bool:
+        # Cheap test of the tight bounds first, masks only when those overlap
+        left_x = left.rect.x + left_shape.x
+        left_y = left.rect.y + left_shape.y
+        right_x = right.rect.x + right_shape.x
+        right_y = right.rect.y + right_shape.y
+        if left_x >= right_x + right_shape.width or right_x >= left_x + left_shape.width or \
+                left_y >= right_y + right_shape.height or right_y >= left_y + left_shape.height:
+            return False
+
+        if left_shape.solid and right_shape.solid:
+            return True
+        return left_shape.mask.overlap(right_shape.mask, (right.rect.x - left.rect.x, right.rect.y - left.rect.y)) \
+            is not None
+
+    @staticmethod
+    def collide(left, right) -> bool:
+        return CollisionShape.overlap(left, left.shape, right, right.shape)
+
+
+class EntityType:
+    # Flyweight with everything the entities of one kind share, created once per config, image and size
+    _cache = {}
+
+    def __init__(self, config: Config, image: str, size: tuple | None = None, speed: float = 0,
+                 interval: int = 0) -> None:
+        self.config = config
+
+        self.image = pygame.image.load(os.path.join(Path.assets_images_path, image)).convert_alpha()
+        if size is not None:
+            self.image = pygame.transform.scale(self.image, size)
+        self.shape = CollisionShape.get((image, size), self.image)
+        self.size = self.image.get_size()
+
+        self.speed = speed
+        self.interval = interval
+        self.screen_width = self.config.config['screen']['width']
+        self.screen_height = self.config.config['screen']['height']
+        self.vp_scrollspeed = self.config.config['main_game']['vp_scrollspeed']
+
+    @classmethod
+    def get(cls, config: Config, image: str, size: tuple | None = None, speed: float = 0, interval: int = 0):
+        # Keyed by the config object as well, entities read their settings through their type
+        key = (config, image, size, speed, interval)
+        entity_type = cls._cache.get(key)
+        if entity_type is None:
+            entity_type = cls._cache[key] = EntityType(config, image, size, speed, interval)
+        return entity_type
+
+
+class Entity(pygame.sprite.Sprite):
+    # pygame.sprite.Sprite has no __slots__, the instance dict only keeps the sprite's group set
+    __slots__ = ('kind', 'rect')
+
+    @property
+    def config(self) -> Config:
+        return self.kind.config
+
+    @property
+    def image(self) -> pygame.Surface:
+        return self.kind.image
+
+    @property
+    def mask(self) -> pygame.mask.Mask:
+        return self.kind.shape.mask
+
+    @property
+    def shape(self) -> CollisionShape:
+        return self.kind.shape
+
+    def draw(self, screen: pygame.Surface) -> None:
+        screen.blit(self.kind.image, self.rect)
+
+
+class Monster(Entity):
+    __slots__ = ('game', 'x', 'y', 'next_shot')
+    monster = None
+
     def __init__(self, config: Config, game: Game, x: int, y: int) -> None:
         super().__init__()
 
-        self.config = config
+        if self.monster is None:
+            image = config.config['main_game']['platform']['static']['image']
+        else:
+            image = config.config['main_game']['monsters'][self.monster]['image']
+        self.kind = EntityType.get(config, image, interval=config.config['main_game']['enemy_ball']['timer'])
         self.game = game
-        
-        self.image = pygame.image.load(
-            os.path.join(Path.assets_images_path,
-                         self.config.config['main_game']['platform']['static']['image'])).convert_alpha()
-        self.rect = self.image.get_rect()
-        self.mask = pygame.mask.from_surface(self.image)
-        
+
+        self.rect = self.kind.image.get_rect()
         self.rect.centerx = x
         self.rect.bottom = y - 5
-        self.position = pygame.Vector2(self.rect.centerx, self.rect.bottom)
-        self.shoot_timer = Timer(self.config.config['main_game']['enemy_ball']['timer'], False)
-    
-    def reload_image(self, img: pygame.Surface):
-        old_pos = self.rect.center
-        self.image = img
-        self.rect = self.image.get_rect()
-        self.rect.center = old_pos
-        self.mask = pygame.mask.from_surface(self.image)
+        self.x = self.rect.centerx
+        self.y = self.rect.bottom
+        self.next_shot = self.game.get_ticks() + self.kind.interval
 
     def update(self, *args, **kwargs):
         if kwargs.get('update_vp', False):
             self.update_vp()
 
-        if self.shoot_timer.is_next_stop_reached():
-            game.state.shots.add(EnemyBall(self.config, pygame.Vector2(self.position), pygame.Vector2(self.game.state.jumper.position)))
+        if self.game.get_ticks() > self.next_shot:
+            self.next_shot = self.game.get_ticks() + self.kind.interval
+            if self.game.state.difficulty.allows(self.game.state.entity_count):
+                self.game.state.shots.add(EnemyBall(self.config, self.game, (self.x, self.y), self.game.state.jumper.position))
     
     def update_vp(self):
-        self.position[1] += self.config.config['main_game']['vp_scrollspeed']
-        self.rect.bottom = self.position[1]
-    
-    def draw(self, screen: pygame.Surface) -> None:
-        screen.blit(self.image, self.rect)
+        self.y += self.kind.vp_scrollspeed
+        self.rect.bottom = self.y
     
 class MonsterBlue(Monster):
-    def __init__(self, config: Config, game: Game, x: int, y: int) -> None:
-        super().__init__(config, game, x, y)
-        self.reload_image(pygame.image.load(
-            os.path.join(Path.assets_images_path,
-                            self.config.config['main_game']['monsters']['blue']['image'])).convert_alpha())
+    __slots__ = ()
+    monster = 'blue'
 
 class MonsterRed(Monster):
-    def __init__(self, config: Config, game: Game, x: int, y: int) -> None:
-        super().__init__(config, game, x, y)
-        self.reload_image(pygame.image.load(
-            os.path.join(Path.assets_images_path,
-                            self.config.config['main_game']['monsters']['red']['image'])).convert_alpha())
+    __slots__ = ()
+    monster = 'red'
 
 class MonsterPurple(Monster):
-    def __init__(self, config: Config, game: Game, x: int, y: int) -> None:
-        super().__init__(config, game, x, y)
-        self.reload_image(pygame.image.load(
-            os.path.join(Path.assets_images_path,
-                            self.config.config['main_game']['monsters']['purple']['image'])).convert_alpha())
+    __slots__ = ()
+    monster = 'purple'
 
 class MonsterBlueFly(Monster):
-    def __init__(self, config: Config, game: Game, x: int, y: int) -> None:
-        super().__init__(config, game, x, y)
-        self.reload_image(pygame.image.load(
-            os.path.join(Path.assets_images_path,
-                            self.config.config['main_game']['monsters']['blue_fly']['image'])).convert_alpha())
+    __slots__ = ()
+    monster = 'blue_fly'
 
-class Ball(pygame.sprite.Sprite):
-    def __init__(self, config: Config, position: pygame.Vector2, target: pygame.Vector2) -> None:
+class Ball(Entity):
+    __slots__ = ('game', 'x', 'y', 'heading_x', 'heading_y')
+    ball = 'ball'
+    hits_monsters = True
+
+    def __init__(self, config: Config, game: Game, position, target) -> None:
         super().__init__()
 
-        self.config = config
+        settings = config.config['main_game'][self.ball]
+        self.kind = EntityType.get(config, settings['image'], (settings['width'], settings['height']), settings['speed'])
         self.game = game
 
-        self.image = pygame.image.load(
-            os.path.join(Path.assets_images_path, self.config.config['main_game']['ball']['image'])).convert_alpha()
-        self.image = pygame.transform.scale(self.image, (self.config.config['main_game']['ball']['width'],
-                                                          self.config.config['main_game']['ball']['height']))
-        self.rect = self.image.get_rect()
+        self.rect = self.kind.image.get_rect()
+        self.x, self.y = position
+        self.rect.center = (self.x, self.y)
 
-        self.position = position
-        self.rect.center = self.position
-        self.target = target
-        self.heading = self.target - self.position
-        self.heading.normalize_ip()
-    
-    def draw(self, screen: pygame.Surface) -> None:
-        screen.blit(self.image, self.rect)
+        self.heading_x = target[0] - self.x
+        self.heading_y = target[1] - self.y
+        length = math.hypot(self.heading_x, self.heading_y) or 1
+        self.heading_x /= length
+        self.heading_y /= length
     
     def update(self, *args, **kwargs) -> None:
         if kwargs.get('update_vp', False):
             self.update_vp()
         
-        if self.rect.x < 0 or self.rect.x > self.config.config['screen']['width']:
+        # Shots fired up or down would otherwise fly on forever
+        if self.rect.x < 0 or self.rect.x > self.kind.screen_width or \
+                self.rect.bottom < 0 or self.rect.top > self.kind.screen_height:
             self.kill()
+            return
         
-        self.position += self.heading * self.config.config['main_game']['ball']['speed'] * game.delta_time
-        self.rect.center = self.position
+        distance = self.kind.speed * self.game.delta_time
+        self.x += self.heading_x * distance
+        self.y += self.heading_y * distance
+        self.rect.center = (self.x, self.y)
 
-        self.collision_monster()
+        if self.hits_monsters:
+            self.collision_monster()
     
     def update_vp(self):
-        self.position[1] += self.config.config['main_game']['vp_scrollspeed']
-        self.rect.bottom = self.position[1]
+        self.y += self.kind.vp_scrollspeed
+        self.rect.centery = self.y
     
     def collision_monster(self):
+        if not isinstance(self.game.state, MainGameState):
+            return
+
         hits = pygame.sprite.spritecollide(
-            self, self.game.state.monsters, False, pygame.sprite.collide_mask)
-        [hit.kill() for hit in hits]
+            self, self.game.state.monsters, False, CollisionShape.collide)
+        for hit in hits:
+            hit.kill()
+            self.game.telemetry.record('kill', monster=type(hit).__name__)
+
+class EnemyBall(Ball):
+    __slots__ = ()
+    ball = 'enemy_ball'
+    hits_monsters = False
+
+class JumpProfile:
+    # Trajectory tables sampled per ms, the jump is split into phases of `duration` ms
+    # with the velocity scaled by the phase weights 10..1 (rise) and 1..10 (fall)
+    def __init__(self, config: Config) -> None:
+        self.config = config
 
-class EnemyBall(pygame.sprite.Sprite):
-    def __init__(self, config: Config, position: pygame.Vector2, target: pygame.Vector2) -> None:
-        super().__init__()
+        jump = self.config.config['main_game']['jumper']['jump']
+        weights = list(range(10, 0, -1))
+        duration = jump['duration']
 
-        self.config = config
-        self.game = game
+        self.rise_time = duration * len(weights)
+        self.fall_time = duration * len(weights)  # Terminal velocity is reached afterwards
+        self.terminal_velocity = jump['gravity_down'] * weights[0]
 
-        self.image = pygame.image.load(
-            os.path.join(Path.assets_images_path, self.config.config['main_game']['enemy_ball']['image'])).convert_alpha()
-        self.image = pygame.transform.scale(self.image, (self.config.config['main_game']['enemy_ball']['width'],
-                                                          self.config.config['main_game']['enemy_ball']['height']))
-        self.rect = self.image.get_rect()
+        self.rise_table = [0.0]
+        for t in range(self.rise_time):
+            self.rise_table.append(self.rise_table[-1] + jump['gravity_up'] * jump['height'] * weights[t // duration])
+
+        self.fall_table = [0.0]
+        for t in range(self.fall_time):
+            self.fall_table.append(self.fall_table[-1] + jump['gravity_down'] * weights[-1 - t // duration])
+
+        self.apex = self.rise_table[-1]
+
+    def rise(self, t: float) -> float:
+        # Height above the take-off point after t ms
+        if t >= self.rise_time:
+            return self.apex
+
+        i = int(t)
+        return self.rise_table[i] + (self.rise_table[i + 1] - self.rise_table[i]) * (t - i)
+
+    def fall(self, t: float) -> float:
+        # Distance fallen from the apex after t ms
+        if t >= self.fall_time:
+            return self.fall_table[-1] + (t - self.fall_time) * self.terminal_velocity
+
+        i = int(t)
+        return self.fall_table[i] + (self.fall_table[i + 1] - self.fall_table[i]) * (t - i)
+
+    def time_to_fall(self, distance: float) -> float:
+        # Inverse of fall(), ms needed to drop the distance below the apex
+        if distance >= self.fall_table[-1]:
+            return self.fall_time + (distance - self.fall_table[-1]) / self.terminal_velocity
+
+        i = bisect.bisect_right(self.fall_table, distance) - 1
+        return i + (distance - self.fall_table[i]) / (self.fall_table[i + 1] - self.fall_table[i])
+
+    def airtime(self, height: float) -> float:
+        # ms from take-off until the jumper passes `height` above the take-off point while falling
+        return self.rise_time + self.time_to_fall(self.apex - height)
+
+    def can_reach(self, dx: float, height: float) -> bool:
+        # dx is the horizontal distance, height the vertical distance above the take-off point
+        if height > self.apex:
+            return False
+        return abs(dx) <= self.config.config['main_game']['jumper']['move_x_speed'] * self.airtime(height)
 
-        self.position = position
-        self.rect.center = self.position
-        self.target = target
-        self.heading = self.target - self.position
-        self.heading.normalize_ip()
-    
-    def draw(self, screen: pygame.Surface) -> None:
-        screen.blit(self.image, self.rect)
-    
-    def update(self, *args, **kwargs) -> None:
-        if kwargs.get('update_vp', False):
-            self.update_vp()
-        
-        if self.rect.x < 0 or self.rect.x > self.config.config['screen']['width']:
-            self.kill()
-        
-        self.position += self.heading * self.config.config['main_game']['enemy_ball']['speed'] * game.delta_time
-        self.rect.center = self.position
-    
-    def update_vp(self):
-        self.position[1] += self.config.config['main_game']['vp_scrollspeed']
-        self.rect.bottom = self.position[1]
 
 class Jumper(pygame.sprite.Sprite):
-    def __init__(self, config: Config, platforms: pygame.sprite.Group) -> None:
+    def __init__(self, config: Config, game: Game, platforms: pygame.sprite.Group) -> None:
         super().__init__()
 
         self.config = config
+        self.game = game
 
         self.image = pygame.image.load(
             os.path.join(Path.assets_images_path, self.config.config['main_game']['jumper']['image'])).convert_alpha()
         self.image = pygame.transform.scale(self.image, (
             self.config.config['main_game']['jumper']['width'], self.config.config['main_game']['jumper']['height']))
         self.rect = self.image.get_rect()
-        self.mask = pygame.mask.from_surface(self.image)
+        self.shape = CollisionShape.get((
+            self.config.config['main_game']['jumper']['image'], self.image.get_size()), self.image)
+        self.mask = self.shape.mask
 
         self.platforms = platforms
         self.shots = pygame.sprite.Group()
+        self.position = pygame.Vector2(0, 0)
+        self.profile = JumpProfile(self.config)
+
+        self.reset()
+
+    def reset(self):
+        self.shots.empty()
 
         center_x = self.config.config['main_game']['jumper']['position']['center_x']
         center_y = self.config.config['main_game']['jumper']['position']['center_y']
 
-        self.position = pygame.Vector2(0, 0)
-
         if center_x:
             self.position[0] = self.config.config['screen']['width'] / 2
         else:
@@ -453,33 +1239,31 @@ class Jumper(pygame.sprite.Sprite):
             self.position[1] = self.config.config['screen']['height'] - \
                           self.config.config['main_game']['jumper']['position']['margin_bottom']
 
-        self.jump_offsets = list(range(10, 0, -1))
         self.jumping = True
         self.jump_offset = 0
-        self.jump_micro_timer = Timer(self.config.config['main_game']['jumper']['jump']['duration'], False)
 
         self.speed_x = 0  # Left < 0, Right > 0
+        self.rect.x = self.position[0]
+        self.rect.y = self.position[1]
 
     def draw(self, screen):
         self.shots.draw(screen)
         screen.blit(self.image, self.rect)
 
     def jump(self):
-        if self.jump_micro_timer.is_next_stop_reached() and self.jumping:
-            self.position[1] -= self.config.config['main_game']['jumper']['jump']['gravity_up'] * self.jump_offsets[
-                self.jump_offset] * game.delta_time
-            self.jump_offset += 1
+        # jump_offset is the time in ms spent in the current phase of the trajectory
+        if self.jumping:
+            self.position[1] -= self.profile.rise(self.jump_offset + self.game.delta_time) - self.profile.rise(self.jump_offset)
+            self.jump_offset += self.game.delta_time
 
-            if self.jump_offset >= len(self.jump_offsets):
-                self.jump_offset = 0
+            if self.jump_offset >= self.profile.rise_time:
+                self.jump_offset -= self.profile.rise_time
                 self.jumping = False
-
-        if not self.jumping:
-            collided_platforms = pygame.sprite.spritecollide(self, self.platforms, False, pygame.sprite.collide_mask)
+        else:
+            collided_platforms = pygame.sprite.spritecollide(self, self.platforms, False, CollisionShape.collide)
 
             if len(collided_platforms) <= 0:
-                self.position[1] += self.config.config['main_game']['jumper']['jump']['gravity_down'] * self.jump_offsets[
-                    self.jump_offset] * game.delta_time
+                self.fall()
             else:
                 can_bounce = False
                 for platform in collided_platforms:
@@ -488,8 +1272,7 @@ class Jumper(pygame.sprite.Sprite):
                         break
                 
                 if not can_bounce:
-                    self.position[1] += self.config.config['main_game']['jumper']['jump']['gravity_down'] * self.jump_offsets[
-                    self.jump_offset] * game.delta_time
+                    self.fall()
                     return
                 
                 for platform in collided_platforms:
@@ -499,8 +1282,12 @@ class Jumper(pygame.sprite.Sprite):
                 self.jumping = True
                 self.jump_offset = 0
 
-                jump_sound = pygame.mixer.Sound(os.path.join(Path.assets_sounds_path, self.config.config['sounds']['jump']))
-                jump_sound.play()
+                self.game.play_sound('jump')
+                self.game.telemetry.record('bounce', platform=type(collided_platforms[0]).__name__)
+
+    def fall(self):
+        self.position[1] += self.profile.fall(self.jump_offset + self.game.delta_time) - self.profile.fall(self.jump_offset)
+        self.jump_offset += self.game.delta_time
         
     def update(self, *args, **kwargs):
         self.collision_monster()
@@ -520,19 +1307,16 @@ class Jumper(pygame.sprite.Sprite):
         self.move()
     
     def collision_monster(self):
-        if not isinstance(game.state, MainGameState):
+        if not isinstance(self.game.state, MainGameState):
             return
 
-        hits = pygame.sprite.spritecollide(
-            self, game.state.monsters, False, pygame.sprite.collide_mask)
-        hits.extend(pygame.sprite.spritecollide(
-            self, game.state.shots, False, pygame.sprite.collide_mask))
-
-        if len(hits) > 0:
-            game.state = GameOverGameState(self.config, game, game.state.points)
+        if pygame.sprite.spritecollide(self, self.game.state.monsters, False, CollisionShape.collide):
+            self.game.state.game_over('monster')
+        elif pygame.sprite.spritecollide(self, self.game.state.shots, False, CollisionShape.collide):
+            self.game.state.game_over('shot')
     
     def move(self):
-        self.position[0] += self.speed_x * game.delta_time
+        self.position[0] += self.speed_x * self.game.delta_time
         
         if self.position[0] < 0:
             self.position[0] = self.config.config['screen']['width']
@@ -557,51 +1341,49 @@ class Jumper(pygame.sprite.Sprite):
         self.speed_x = self.config.config['main_game']['jumper']['move_x_speed']
     
     def shoot(self, click_position):
-        self.shots.add(Ball(self.config, pygame.Vector2(self.position), pygame.Vector2(click_position)))
+        self.shots.add(Ball(self.config, self.game, self.position, click_position))
     
     def update_vp(self):
         self.position[1] += self.config.config['main_game']['vp_scrollspeed']
         self.rect.y = self.position[1]
 
-class Platform(pygame.sprite.Sprite):
-    def __init__(self, config: Config, width: int, height: int, x: int | None, y: int | None) -> None:
+class Platform(Entity):
+    __slots__ = ('game', 'bouncable', 'x', 'moving_speed', 'moving_direction')
+    platform = 'static'
+
+    def __init__(self, config: Config, game: Game, width: int, height: int, x: int | None, y: int | None,
+                 rng: random.Random = random) -> None:
         super().__init__()
 
-        self.config = config
-        self.size = (width, height)
+        self.game = game
 
-        self.image = pygame.image.load(
-            os.path.join(Path.assets_images_path,
-                         self.config.config['main_game']['platform']['static']['image'])).convert_alpha()
-        self.image = pygame.transform.scale(self.image, self.size)
-        self.rect = self.image.get_rect()
-        self.mask = pygame.mask.from_surface(self.image)
+        self.kind = EntityType.get(config, config.config['main_game']['platform'][self.platform]['image'], (width, height))
+        self.rect = self.kind.image.get_rect()
         self.bouncable = True
 
         if x is None:
-            self.rect.x = self.config.config['screen']['width'] / 2 - width / 2
+            self.rect.x = config.config['screen']['width'] / 2 - width / 2
         else:
             self.rect.x = x
 
         if y is None:
-            self.rect.y = self.config.config['screen']['height'] / 2 - height / 2
+            self.rect.y = config.config['screen']['height'] / 2 - height / 2
         else:
-            self.rect.y = self.config.config['screen']['height'] - y
+            self.rect.y = config.config['screen']['height'] - y
 
-        self.position = pygame.Vector2(self.rect.x, self.rect.y)
+        self.x = self.rect.x
         self.moving_speed = 0
         self.moving_direction = -1
+
+    @property
+    def size(self) -> tuple:
+        return self.kind.size
     
-    def reload_image(self, img: pygame.Surface):
+    def reload_image(self, image: str):
         old_pos = self.rect.center
-        self.image = img
-        self.image = pygame.transform.scale(self.image, self.size)
-        self.rect = self.image.get_rect()
+        self.kind = EntityType.get(self.config, image, self.size)
+        self.rect = self.kind.image.get_rect()
         self.rect.center = old_pos
-        self.mask = pygame.mask.from_surface(self.image)
-
-    def draw(self, screen):
-        screen.blit(self.image, self.rect)
 
     def update(self, *args, **kwargs):
         if kwargs.get('update_vp', False):
@@ -610,26 +1392,25 @@ class Platform(pygame.sprite.Sprite):
             self.bounced()
     
     def update_vp(self):
-        self.rect.y += self.config.config['main_game']['vp_scrollspeed']
+        self.rect.y += self.kind.vp_scrollspeed
     
     def bounced(self):
         pass
 
 class GreenPlatform(Platform):
-    def __init__(self, config: Config, width: int, height: int, x: int | None, y: int | None):
-        super().__init__(config, width, height, x, y)
+    __slots__ = ()
 
 class BluePlatform(Platform):
-    def __init__(self, config: Config, width: int, height: int, x: int | None, y: int | None):
-        super().__init__(config, width, height, x, y)
-        self.reload_image(pygame.image.load(
-            os.path.join(Path.assets_images_path,
-                         self.config.config['main_game']['platform']['moving']['image'])).convert_alpha())
-            
-
-        self.moving_speed = random.uniform(
-            self.config.config['main_game']['platform']['moving']['min_speed'],
-            self.config.config['main_game']['platform']['moving']['max_speed']
+    __slots__ = ()
+    platform = 'moving'
+
+    def __init__(self, config: Config, game: Game, width: int, height: int, x: int | None, y: int | None,
+                 rng: random.Random = random):
+        super().__init__(config, game, width, height, x, y, rng)
+
+        self.moving_speed = rng.uniform(
+            config.config['main_game']['platform']['moving']['min_speed'],
+            config.config['main_game']['platform']['moving']['max_speed']
         )
         self.moving_direction = -1 # < 0 left, > 0 right
     
@@ -637,31 +1418,147 @@ class BluePlatform(Platform):
         super().update(*args, **kwargs)
 
         # Change direction
-        if self.position[0] <= 0 or self.position[0] >= self.config.config['screen']['width'] - self.rect.width:
+        if self.x <= 0 or self.x >= self.kind.screen_width - self.rect.width:
             self.moving_direction *= -1
         
         # Move
-        self.position[0] += self.moving_direction * self.moving_speed * game.delta_time
-        self.rect.x = self.position[0]
+        self.x += self.moving_direction * self.moving_speed * self.game.delta_time
+        self.rect.x = self.x
 
 class BrownPlatform(Platform):
-    def __init__(self, config: Config, width: int, height: int, x: int | None, y: int | None):
-        super().__init__(config, width, height, x, y)
-        self.reload_image(pygame.image.load(
-            os.path.join(Path.assets_images_path,
-                         self.config.config['main_game']['platform']['breaking']['image'])).convert_alpha())
-        self.bouncable = True
+    __slots__ = ()
+    platform = 'breaking'
     
     def bounced(self):
         super().bounced()
+        self.break_platform()
+
+        self.game.play_sound('platform_break')
 
-        self.reload_image(pygame.image.load(
-            os.path.join(Path.assets_images_path,
-                         self.config.config['main_game']['platform']['breaking']['image_broken'])).convert_alpha())
+    def break_platform(self):
+        self.reload_image(self.config.config['main_game']['platform']['breaking']['image_broken'])
         self.bouncable = False
 
-        break_sound = pygame.mixer.Sound(os.path.join(Path.assets_sounds_path, self.config.config['sounds']['platform_break']))
-        break_sound.play()        
+class PlatformGenerator:
+    # Places platforms so that each static platform can be reached from the previous one
+    def __init__(self, config: Config, profile: JumpProfile, rng: random.Random) -> None:
+        self.config = config
+        self.profile = profile
+        self.rng = rng
+
+        self.screen_width = self.config.config['screen']['width']
+        self.platform_width = self.config.config['main_game']['platform']['width']
+
+        # Keep a margin below the apex, the jumper has to get its feet over the platform
+        self.max_height = int(self.profile.apex * self.config.config['main_game']['platform']['reach_margin'])
+        distance = self.config.config['main_game']['platform']['platform_distance']
+        self.min_distance, self.max_distance = sorted((distance['min'], distance['max']))
+        self.min_distance = min(self.min_distance, self.max_height // 2)
+
+        # Horizontal reach for every height above the take-off point, including landing on the platform edge
+        move_x_speed = self.config.config['main_game']['jumper']['move_x_speed']
+        self.reach = [move_x_speed * self.profile.airtime(height) + self.platform_width / 2
+                      for height in range(self.max_height + 1)]
+
+        self.anchor = None  # Highest platform which is guaranteed to stay where it is and to bounce
+
+    def reset(self, platforms: pygame.sprite.Group) -> None:
+        anchors = [platform for platform in platforms if isinstance(platform, GreenPlatform)] or platforms.sprites()
+        self.anchor = min(anchors, key=lambda platform: platform.rect.y)
+
+    def horizontal_distance(self, x1: float, x2: float) -> float:
+        # Jumper.move wraps around the screen edges
+        distance = abs(x1 - x2) % self.screen_width
+        return min(distance, self.screen_width - distance)
+
+    def is_reachable(self, anchor: Platform, x: int, top: int) -> bool:
+        height = anchor.rect.top - top
+        if height > self.max_height:
+            return False
+        if height < 0:
+            return True
+        return self.horizontal_distance(anchor.rect.centerx, x + self.platform_width / 2) <= self.reach[height]
+
+    def next_platform(self, highest: Platform, platform_type, distance_scale: float = 1) -> tuple:
+        if not self.anchor.alive():
+            self.anchor = highest
+
+        chain = self.anchor.rect.top - highest.rect.top
+        room = self.max_height - chain
+
+        # Moving and breaking platforms can't be relied on, leave room for the next static one above them
+        if platform_type is not GreenPlatform and room < 2 * self.min_distance:
+            platform_type = GreenPlatform
+
+        low = max(1, min(int(self.min_distance * distance_scale), room))
+        high = max(low, min(int(self.max_distance * distance_scale), room))
+        if platform_type is not GreenPlatform:
+            high = max(low, min(high, room - self.min_distance))
+
+        gap = self.rng.randint(low, high)
+        top = highest.rect.top - gap
+
+        if platform_type is not GreenPlatform:
+            return platform_type, self.rng.randint(0, self.screen_width - self.platform_width), top
+
+        reach = self.reach[min(chain + gap, self.max_height)]
+        if reach >= self.screen_width / 2:
+            x = self.rng.randint(0, self.screen_width - self.platform_width)
+        else:
+            center = (self.anchor.rect.centerx + self.rng.uniform(-reach, reach)) % self.screen_width
+            x = int(min(max(center - self.platform_width / 2, 0), self.screen_width - self.platform_width))
+
+            if not self.is_reachable(self.anchor, x, top):
+                x = self.anchor.rect.x  # Clamping to the screen moved it out of reach
+
+        return platform_type, x, top
+
+    def placed(self, platform: Platform) -> None:
+        if isinstance(platform, GreenPlatform):
+            self.anchor = platform
+
+class Difficulty:
+    # Ramps the level with the height reached and limits spawns to what the frame time allows
+    def __init__(self, config: Config) -> None:
+        self.config = config
+        self.settings = self.config.config['difficulty']
+
+        self.frame_target = 1000 / self.config.config['screen']['fps'] * self.settings['budget']['frame_budget']
+        self.reset()
+
+    def reset(self) -> None:
+        self.level = 0.0  # 0 at the start, 1 once ramp_height is reached
+        self.frame_cost = 0.0  # Smoothed update and draw time in ms
+        self.entity_budget = self.settings['budget']['max_entities']
+
+    def update(self, vp_offset: float) -> None:
+        self.level = min(1.0, vp_offset / self.settings['ramp_height'])
+
+    def interpolate(self, values: dict) -> float:
+        return values['start'] + (values['end'] - values['start']) * self.level
+
+    def platform_weights(self) -> list:
+        weights = self.settings['platform_weights']
+        return [self.interpolate({'start': weights['start'][name], 'end': weights['end'][name]})
+                for name in ('static', 'moving', 'breaking')]
+
+    def platform_distance(self) -> float:
+        return self.interpolate(self.settings['platform_distance'])
+
+    def monster_chance(self) -> float:
+        return self.interpolate(self.settings['monster_chance'])
+
+    def observe_frame(self, frame_cost: float) -> None:
+        budget = self.settings['budget']
+        self.frame_cost += (frame_cost - self.frame_cost) * budget['smoothing']
+
+        if self.frame_cost > self.frame_target:
+            self.entity_budget = max(budget['min_entities'], int(self.entity_budget * 0.9))
+        elif self.frame_cost < self.frame_target * 0.75 and self.entity_budget < budget['max_entities']:
+            self.entity_budget += 1
+
+    def allows(self, entity_count: int) -> bool:
+        return entity_count < self.entity_budget
 
 class MainGameState(GameState):
     def __init__(self, config: Config, game: Game):
@@ -671,10 +1568,37 @@ class MainGameState(GameState):
 
         self.platforms = pygame.sprite.Group()
         self.monsters = pygame.sprite.Group()
+        self.shots = pygame.sprite.Group()
+        self.jumper = Jumper(self.config, self.game, self.platforms)
+        self.random = random.Random()
+        self.generator = PlatformGenerator(self.config, self.jumper.profile, self.random)
+        self.difficulty = Difficulty(self.config)
+        self.track = None  # Shared RaceTrack in race mode, platforms are then taken from it in order
+        self.track_index = 0
+
+        self.savegame_file = os.path.join(Path.runtime_path, self.config.config['savegame']['file'])
+        self.autosave_timer = Timer(self.config.config['savegame']['autosave_interval'], False, self.game.get_ticks)
+
+    def enter(self, **kwargs):
+        if kwargs.get('snapshot') is not None:
+            Snapshot.loads(self, kwargs['snapshot'])
+        else:
+            self.reset(kwargs.get('seed'))
+
+    def reset(self, seed=None):
+        self.platforms.empty()
+        self.monsters.empty()
+        self.shots.empty()
         self.points = 0
+        self.rendered_points = None
         self.vp_offset = 0
+        self.entity_count = 0
+        self.track_index = 0
+        self.random.seed(seed)
+        self.difficulty.reset()
+        self.game.telemetry.record('run', seed=seed)
 
-        start_platform = GreenPlatform(self.config,
+        start_platform = GreenPlatform(self.config, self.game,
                                        self.config.config['main_game']['jumper']['start_platform']['width'],
                                        self.config.config['main_game']['jumper']['start_platform']['height'],
                                        None,
@@ -682,17 +1606,23 @@ class MainGameState(GameState):
                                        self.config.config['main_game']['jumper']['height'])
                                           
         self.platforms.add(start_platform)
+        self.generator.reset(self.platforms)
 
-        self.jumper = Jumper(self.config, self.platforms)
-        self.shots = pygame.sprite.Group()
+        self.jumper.reset()
         self.regenerate_platforms(on_boot=True)
 
         # Points
         self.render_points()
     
     def render_points(self):
-        font = pygame.font.Font(os.path.join(Path.assets_fonts_path, 'al-seana.ttf'), 30)
-        self.points_text = font.render(f"Points: {round(self.points)}", True, (0, 0, 0))
+        # Only re-render when the displayed value changes
+        points = round(self.points)
+        if points == self.rendered_points:
+            return
+        self.rendered_points = points
+
+        font = self.game.font
+        self.points_text = font.render(f"Points: {points}", True, (0, 0, 0))
         self.points_text_rect = self.points_text.get_rect()
         self.points_text_rect.top = self.config.config['screen']['height'] - self.points_text_rect.height - 15
         self.points_text_rect.right = self.config.config['screen']['width'] - 15
@@ -704,64 +1634,118 @@ class MainGameState(GameState):
         self.shots.draw(screen)
         screen.blit(self.points_text, self.points_text_rect)
 
+    def capture(self) -> tuple:
+        # Immutable copy of what draw() would blit, in the same order
+        blits = [(shot.image, shot.rect.topleft) for shot in self.jumper.shots]
+        blits.append((self.jumper.image, self.jumper.rect.topleft))
+        blits += [(platform.image, platform.rect.topleft) for platform in self.platforms]
+        blits += [(monster.image, monster.rect.topleft) for monster in self.monsters]
+        blits += [(shot.image, shot.rect.topleft) for shot in self.shots]
+        blits.append((self.points_text, self.points_text_rect.topleft))
+        return tuple(blits)
+
     def move_viewport(self):
         if self.jumper.rect.top < 0:
             self.jumper.update(update_vp=True)
+            if self.game.state is not self:
+                return  # The jumper ran into a monster, nothing else may act on GameOverGameState
+
             self.platforms.update(update_vp=True)
             self.monsters.update(update_vp=True)
             self.shots.update(update_vp=True)
             self.vp_offset += self.config.config['main_game']['vp_scrollspeed']
     
     def generate_platform_type(self):
-        platforms = [BluePlatform, BluePlatform, BrownPlatform]
-        [platforms.append(GreenPlatform) for _ in range(10)]
+        platforms = [GreenPlatform, BluePlatform, BrownPlatform]
+
+        return self.random.choices(platforms, self.difficulty.platform_weights())[0]
 
-        return random.choice(platforms)
+    def count_entities(self):
+        return len(self.platforms) + len(self.monsters) + len(self.shots) + len(self.jumper.shots)
 
     def regenerate_platforms(self, *args, **kwargs):
-        # Spawn new platforms
-        if len(self.platforms) < self.config.config['main_game']['platform']['max_platforms']:
-            get_highest_platform = min([(v, v.rect.y) for v in self.platforms.sprites()], key=lambda x: x[1])[0]
-            random_position = (
-                random.randint(0, self.config.config['screen']['width'] - self.config.config['main_game']['platform']['width']),
-                self.config.config['screen']['height'] - get_highest_platform.rect.centery + random.randint(
-                    self.config.config['main_game']['platform']['platform_distance']['max'],
-                    self.config.config['main_game']['platform']['platform_distance']['min']
-                )
-            )
-
-            random_platform = self.generate_platform_type()
-
-            new_platform = random_platform(self.config,
-                                           self.config.config['main_game']['platform']['width'],
-                                           self.config.config['main_game']['platform']['height'],
-                                           random_position[0],
-                                           random_position[1])
-            self.platforms.add(new_platform)
+        # Spawn new platforms, beyond the minimum only as many as the entity budget allows
+        max_platforms = self.config.config['main_game']['platform']['max_platforms']
+        min_platforms = self.config.config['difficulty']['budget']['min_platforms']
+        while len(self.platforms) < max_platforms and (len(self.platforms) < min_platforms or
+                                                        self.difficulty.allows(self.count_entities())):
+            if self.track is None:
+                new_platform, monster = self.spawn_platform()
+            else:
+                new_platform, monster = self.track.next_platform(self)
 
-            # Spawn monsters
-            if random.randint(0, 20) == 1 and isinstance(new_platform, GreenPlatform):
-                monsters = [MonsterBlue, MonsterBlueFly, MonsterPurple, MonsterRed]
-                monster = random.choice(monsters)
-                monster = monster(self.config, self.game, new_platform.rect.centerx, new_platform.rect.centery)
+            self.platforms.add(new_platform)
+            self.generator.placed(new_platform)
+            self.game.telemetry.record('spawn', entity=type(new_platform).__name__)
 
+            if monster is not None:
                 self.monsters.add(monster)
+                self.game.telemetry.record('spawn', entity=type(monster).__name__)
 
-        # Delete old platforms
-        for platform in self.platforms.sprites():
-            if platform.rect.top > self.config.config['screen']['height']:
-                self.platforms.remove(platform)
+        # Delete everything below the screen, it still counts against the entity budget otherwise
+        for group in (self.platforms, self.monsters, self.shots, self.jumper.shots):
+            for sprite in group.sprites():
+                if sprite.rect.top > self.config.config['screen']['height']:
+                    group.remove(sprite)
         
+    def spawn_platform(self):
+        # Next platform from the generator and possibly a monster on it, neither is added yet
+        get_highest_platform = min(self.platforms.sprites(), key=lambda platform: platform.rect.y)
+        random_platform, x, top = self.generator.next_platform(get_highest_platform, self.generate_platform_type(),
+                                                               self.difficulty.platform_distance())
+
+        new_platform = random_platform(self.config, self.game,
+                                       self.config.config['main_game']['platform']['width'],
+                                       self.config.config['main_game']['platform']['height'],
+                                       x,
+                                       self.config.config['screen']['height'] - top,
+                                       self.random)
+
+        # Spawn monsters
+        monster = None
+        if self.random.random() < self.difficulty.monster_chance() and isinstance(new_platform, GreenPlatform) and \
+                self.difficulty.allows(self.count_entities() + 1):
+            monsters = [MonsterBlue, MonsterBlueFly, MonsterPurple, MonsterRed]
+            monster = self.random.choice(monsters)
+            monster = monster(self.config, self.game, new_platform.rect.centerx, new_platform.rect.centery)
+
+        return new_platform, monster
+
     def init_gameover(self):
         if self.jumper.rect.top > self.config.config['screen']['height']:
-            game.state = GameOverGameState(self.config, game, self.points)
+            self.game_over('fall')
+
+    def game_over(self, cause='fall'):
+        if self.game.state is self:
+            self.game.telemetry.record('death', cause=cause, points=self.points, height=self.vp_offset)
+            self.game.snapshots.remove(self.savegame_file)
+            self.game.states.switch(GameOverGameState, points=self.points)
+
+    def save(self):
+        if not self.game.headless:
+            self.game.snapshots.save(self.savegame_file, Snapshot.dumps(self))
 
     def update(self):
+        self.difficulty.observe_frame(self.game.frame_cost)
+        self.difficulty.update(self.vp_offset)
+        self.entity_count = self.count_entities()
+
         self.move_viewport()
+        if self.game.state is not self:
+            return
+
         self.regenerate_platforms()
         self.init_gameover()
+        if self.game.state is not self:
+            return
+
+        if self.autosave_timer.is_next_stop_reached():
+            self.save()
 
         self.jumper.update()
+        if self.game.state is not self:
+            return
+
         self.platforms.update()
         self.monsters.update()
         self.shots.update()
@@ -786,7 +1770,8 @@ class MainGameState(GameState):
         self.jumper.update(shoot=True, shoot_position=position)
     
     def pause(self):
-        game.state = PauseGameState(self.config, self.game, self)
+        self.save()
+        self.game.states.push(PauseGameState, points=self.points)
 
     def handle_events(self, event) -> None:
         if event.type == pygame.KEYDOWN:
@@ -803,43 +1788,236 @@ class MainGameState(GameState):
                 self.keystroke_right(stop=True)
         elif event.type == pygame.MOUSEBUTTONDOWN:
             if event.button == 1:
-                self.keystroke_shoot(pygame.Vector2(pygame.mouse.get_pos()))
+                self.keystroke_shoot(pygame.Vector2(self.game.renderer.to_logical(event.pos)))
+
+class Snapshot:
+    # Binary layout: header, jumper, rng, then counted records of platforms, monsters and shots
+    magic = b'DJSV'
+    version = 2
+
+    header = struct.Struct('<4sHdd')  # magic, version, points, vp_offset
+    jumper = struct.Struct('<dddd?d')  # x, y, rect.y, jump_offset, jumping, speed_x
+    rng = struct.Struct('<i625I?d')  # version, mersenne twister state, gauss_next
+    count = struct.Struct('<H')
+    platform = struct.Struct('<BHHiiddb?')  # type, size, rect, position x, speed, direction, bouncable
+    monster = struct.Struct('<Biiddi')  # type, rect, position, shoot timer
+    ball = struct.Struct('<Bdddd')  # owner, position, heading
+
+    platform_types = (GreenPlatform, BluePlatform, BrownPlatform)
+    monster_types = (MonsterBlue, MonsterRed, MonsterPurple, MonsterBlueFly)
+    ball_types = (Ball, EnemyBall)
+
+    @classmethod
+    def dumps(cls, state: MainGameState) -> bytes:
+        now = state.game.get_ticks()
+        jumper = state.jumper
+        rng_version, rng_internal, rng_gauss = state.random.getstate()
+
+        parts = [
+            cls.header.pack(cls.magic, cls.version, state.points, state.vp_offset),
+            cls.jumper.pack(jumper.position[0], jumper.position[1], jumper.rect.y, jumper.jump_offset,
+                            jumper.jumping, jumper.speed_x),
+            cls.rng.pack(rng_version, *rng_internal, rng_gauss is not None, rng_gauss or 0.0),
+            cls.count.pack(len(state.platforms))
+        ]
+        for platform in state.platforms:
+            parts.append(cls.platform.pack(cls.platform_types.index(type(platform)), *platform.size,
+                                           platform.rect.x, platform.rect.y, platform.x,
+                                           platform.moving_speed, platform.moving_direction, platform.bouncable))
+
+        parts.append(cls.count.pack(len(state.monsters)))
+        for monster in state.monsters:
+            parts.append(cls.monster.pack(cls.monster_types.index(type(monster)), monster.rect.x, monster.rect.y,
+                                          monster.x, monster.y, int(monster.next_shot - now)))
+
+        shots = jumper.shots.sprites() + state.shots.sprites()
+        parts.append(cls.count.pack(len(shots)))
+        for shot in shots:
+            parts.append(cls.ball.pack(cls.ball_types.index(type(shot)), shot.x, shot.y, shot.heading_x, shot.heading_y))
+
+        return b''.join(parts)
+
+    @staticmethod
+    def entity_type(types: tuple, type_id: int):
+        if type_id >= len(types):
+            raise ValueError(f'Unknown entity type {type_id} in savegame')
+        return types[type_id]
+
+    @classmethod
+    def loads(cls, state: MainGameState, data: bytes) -> None:
+        magic, version, points, vp_offset = cls.header.unpack_from(data, 0)
+        if magic != cls.magic or version != cls.version:
+            raise ValueError(f'Unsupported savegame (version {version})')
+        offset = cls.header.size
+
+        now = state.game.get_ticks()
+        screen_height = state.config.config['screen']['height']
+
+        state.platforms.empty()
+        state.monsters.empty()
+        state.shots.empty()
+        state.points = points
+        state.rendered_points = None
+        state.vp_offset = vp_offset
+
+        jumper = state.jumper
+        jumper.reset()
+        x, y, rect_y, jump_offset, jumping, speed_x = cls.jumper.unpack_from(data, offset)
+        offset += cls.jumper.size
+        jumper.position.update(x, y)
+        jumper.rect.x, jumper.rect.y = x, rect_y
+        jumper.jump_offset = jump_offset
+        jumper.jumping = jumping
+        jumper.speed_x = speed_x
+
+        rng = cls.rng.unpack_from(data, offset)
+        offset += cls.rng.size
+
+        (count,) = cls.count.unpack_from(data, offset)
+        offset += cls.count.size
+        for _ in range(count):
+            type_id, width, height, rect_x, rect_y, position_x, speed, direction, bouncable = \
+                cls.platform.unpack_from(data, offset)
+            offset += cls.platform.size
+
+            platform = cls.entity_type(cls.platform_types, type_id)(state.config, state.game, width, height, rect_x,
+                                                                          screen_height - rect_y)
+            if not bouncable:
+                platform.break_platform()
+            platform.rect.x, platform.rect.y = rect_x, rect_y
+            platform.x = position_x
+            platform.moving_speed = speed
+            platform.moving_direction = direction
+            state.platforms.add(platform)
+
+        (count,) = cls.count.unpack_from(data, offset)
+        offset += cls.count.size
+        for _ in range(count):
+            type_id, rect_x, rect_y, position_x, position_y, shoot_timer = cls.monster.unpack_from(data, offset)
+            offset += cls.monster.size
+
+            monster = cls.entity_type(cls.monster_types, type_id)(state.config, state.game, 0, 0)
+            monster.rect.x, monster.rect.y = rect_x, rect_y
+            monster.x, monster.y = position_x, position_y
+            monster.next_shot = now + shoot_timer
+            state.monsters.add(monster)
+
+        (count,) = cls.count.unpack_from(data, offset)
+        offset += cls.count.size
+        for _ in range(count):
+            type_id, x, y, heading_x, heading_y = cls.ball.unpack_from(data, offset)
+            offset += cls.ball.size
+
+            shot = cls.entity_type(cls.ball_types, type_id)(state.config, state.game, (x, y),
+                                                                   (x + heading_x, y + heading_y))
+            (jumper.shots if type_id == 0 else state.shots).add(shot)
+
+        state.generator.reset(state.platforms)
+
+        # Restore the rng last, creating the entities above may consume random numbers
+        state.random.setstate((rng[0], tuple(rng[1:626]), rng[627] if rng[626] else None))
+        state.render_points()
+
+    @staticmethod
+    def write(path: str, data: bytes) -> None:
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())  # The rename must not land before the data does
+        os.replace(temp_path, path)
+
+    @staticmethod
+    def read(path: str) -> bytes | None:
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def remove(path: str) -> None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class SnapshotWriter:
+    # Saves and removes savegames in order on a background thread, the frame loop never waits for the disk
+    def __init__(self, enabled: bool = True) -> None:
+        self.enabled = enabled
+        self.jobs = queue.Queue()
+        self.writer = None
+        if self.enabled:
+            self.writer = threading.Thread(target=self.write_loop, daemon=True)
+            self.writer.start()
+
+    def save(self, path: str, data: bytes) -> None:
+        if self.enabled:
+            self.jobs.put((path, data))
+
+    def remove(self, path: str) -> None:
+        if self.enabled:
+            self.jobs.put((path, None))
+
+    def write_loop(self) -> None:
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+
+            path, data = job
+            try:
+                if data is None:
+                    Snapshot.remove(path)
+                else:
+                    Snapshot.write(path, data)
+            except OSError as e:
+                print(e)
+
+    def close(self) -> None:
+        if not self.enabled:
+            return
+
+        # Pending jobs are still written, the last save or remove must reach the disk
+        self.enabled = False
+        self.jobs.put(None)
+        self.writer.join()
+
 
 class Highscore:
     def __init__(self, config: Config):
         self.config = config
         self.highscore_file = os.path.join(Path.runtime_path, self.config.config['highscore']['file'])
+        self.highscores = self.read_highscores()
         self.highscore = self.load_highscore()
-    
-    def load_highscore(self) -> int:
+
+    def read_highscores(self) -> list:
         try:
             with open(self.highscore_file, 'r') as f:
                 highscores = json.load(f)
                 highscores.sort(reverse=True)
-            
-                return highscores[0]
+
+                return highscores
         except:
-            return 0
+            return []
+    
+    def load_highscore(self) -> int:
+        return self.highscores[0] if self.highscores else 0
     
     def write_highscore(self, points) -> int:
-        with open(self.highscore_file, 'r+') as f:
-            highscores = json.load(f)
-            highscores.append(points)
-            highscores.sort(reverse=True)
-            highscores = highscores[:self.config.config['highscore']['max_highscores']]
-
-            highscores = json.dumps(highscores)
-            f.seek(0)
-            f.write(highscores)
-            f.truncate()
-            f.close()
+        self.highscores.append(points)
+        self.highscores.sort(reverse=True)
+        del self.highscores[self.config.config['highscore']['max_highscores']:]
+
+        with open(self.highscore_file, 'w') as f:
+            json.dump(self.highscores, f)
         return self.load_highscore()
 
 class GameOverGameState(GameState):
-    def __init__(self, config: Config, game: Game, points: float) -> None:
-        self.config = config
-        self.game = game
-        self.points = points
+    def __init__(self, config: Config, game: Game) -> None:
+        super().__init__(config, game)
 
         self.logo = pygame.image.load(
             os.path.join(Path.assets_images_path, self.config.config['images']['logo'])).convert_alpha()
@@ -862,25 +2040,29 @@ class GameOverGameState(GameState):
         self.restart_button = Button(config, 250, 50, None,
                                    self.logo_rect.bottom + self.config.config['start_screen']['play_button'][
                                        'logo_margin_top'], 'Retry', (0, 0, 0),
-                                   pygame.font.Font(os.path.join(Path.assets_fonts_path, 'al-seana.ttf'), 30),
-                                   self.restart_game, GameOverGameState)
+                                   self.game.font,
+                                   self.restart_game, GameOverGameState, self.game)
         self.quit_button = Button(config, 250, 50, None,
                                   self.restart_button.rect.bottom + self.config.config['start_screen']['quit_button'][
                                       'play_margin_top'], 'Quit', (0, 0, 0),
-                                  pygame.font.Font(os.path.join(Path.assets_fonts_path, 'al-seana.ttf'), 30),
-                                  self.stop_game, GameOverGameState)
+                                  self.game.font,
+                                  self.stop_game, GameOverGameState, self.game)
 
-        game.buttons.add(self.restart_button)
-        game.buttons.add(self.quit_button)
+        self.buttons.add(self.restart_button, self.quit_button)
 
-        font = pygame.font.Font(os.path.join(Path.assets_fonts_path, 'al-seana.ttf'), 30)
+    def enter(self, **kwargs) -> None:
+        self.points = kwargs.get('points', 0)
+
+        font = self.game.font
         self.points_text = font.render(f'Points: {round(self.points)}', True, (0, 0, 0))
         self.points_text_rect = self.points_text.get_rect()
         self.points_text_rect.centerx = self.config.config['screen']['width'] / 2
         self.points_text_rect.centery = self.quit_button.rect.bottom + 100
 
-        highscore_obj = Highscore(config)
-        highscore = highscore_obj.write_highscore(self.points)
+        if self.game.headless:
+            highscore = max(self.game.highscore.load_highscore(), self.points)
+        else:
+            highscore = self.game.highscore.write_highscore(self.points)
 
         self.highscore_text = font.render(f'Highscore: {round(highscore)}', True, (0, 0, 0))
         self.highscore_text_rect = self.highscore_text.get_rect()
@@ -900,16 +2082,14 @@ class GameOverGameState(GameState):
         self.quit_button.update()
 
     def restart_game(self):
-        game.state = MainGameState(self.config, game)
+        self.game.states.switch(MainGameState)
     
     def stop_game(self):
         self.game.running = False
     
 class PauseGameState(GameState):
-    def __init__(self, config: Config, game: Game, game_snapshot: MainGameState) -> None:
-        self.config = config
-        self.game = game
-        self.game_snapshot = game_snapshot
+    def __init__(self, config: Config, game: Game) -> None:
+        super().__init__(config, game)
 
         self.logo = pygame.image.load(
             os.path.join(Path.assets_images_path, self.config.config['images']['logo'])).convert_alpha()
@@ -932,31 +2112,32 @@ class PauseGameState(GameState):
         self.unpause_button = Button(config, 250, 50, None,
                                    self.logo_rect.bottom + self.config.config['start_screen']['play_button'][
                                        'logo_margin_top'], 'Unpause', (0, 0, 0),
-                                   pygame.font.Font(os.path.join(Path.assets_fonts_path, 'al-seana.ttf'), 30),
-                                   self.unpause, PauseGameState)
+                                   self.game.font,
+                                   self.unpause, PauseGameState, self.game)
         self.restart_button = Button(config, 250, 50, None,
                                    self.unpause_button.rect.bottom + self.config.config['start_screen']['quit_button'][
                                        'play_margin_top'], 'Restart', (0, 0, 0),
-                                   pygame.font.Font(os.path.join(Path.assets_fonts_path, 'al-seana.ttf'), 30),
-                                   self.restart_game, PauseGameState)
+                                   self.game.font,
+                                   self.restart_game, PauseGameState, self.game)
         self.quit_button = Button(config, 250, 50, None,
                                   self.restart_button.rect.bottom + self.config.config['start_screen']['quit_button'][
                                       'play_margin_top'], 'Quit', (0, 0, 0),
-                                  pygame.font.Font(os.path.join(Path.assets_fonts_path, 'al-seana.ttf'), 30),
-                                  self.stop_game, PauseGameState)
+                                  self.game.font,
+                                  self.stop_game, PauseGameState, self.game)
+
+        self.buttons.add(self.unpause_button, self.restart_button, self.quit_button)
 
-        game.buttons.add(self.restart_button)
-        game.buttons.add(self.quit_button)
-        game.buttons.add(self.unpause_button)
+    def enter(self, **kwargs) -> None:
+        self.points = kwargs.get('points', 0)
 
-        font = pygame.font.Font(os.path.join(Path.assets_fonts_path, 'al-seana.ttf'), 30)
-        self.points_text = font.render(f'Points: {round(game_snapshot.points)}', True, (0, 0, 0))
+        font = self.game.font
+        self.points_text = font.render(f'Points: {round(self.points)}', True, (0, 0, 0))
         self.points_text_rect = self.points_text.get_rect()
         self.points_text_rect.centerx = self.config.config['screen']['width'] / 2
         self.points_text_rect.centery = self.quit_button.rect.bottom + 100
 
-        highscore_obj = Highscore(config)
-        highscore = highscore_obj.write_highscore(game_snapshot.points)
+        # The run is only recorded once it is left, pausing repeatedly must not fill the highscore list
+        highscore = max(self.game.highscore.load_highscore(), self.points)
 
         self.highscore_text = font.render(f'Highscore: {round(highscore)}', True, (0, 0, 0))
         self.highscore_text_rect = self.highscore_text.get_rect()
@@ -983,15 +2164,792 @@ class PauseGameState(GameState):
                 self.unpause()
 
     def unpause(self):
-        game.state = self.game_snapshot
+        self.game.states.pop()
 
     def restart_game(self):
-        game.state = MainGameState(self.config, game)
+        self.game.highscore.write_highscore(self.points)
+        self.game.snapshots.remove(self.game.states.get(MainGameState).savegame_file)
+        self.game.states.switch(MainGameState)
     
     def stop_game(self):
+        self.game.highscore.write_highscore(self.points)
+        self.game.snapshots.remove(self.game.states.get(MainGameState).savegame_file)
         self.game.running = False
 
+class DoodleJumpEnv:
+    # Programmatic, headless access to MainGameState with a gym style reset/step interface
+    actions = ('noop', 'left', 'right', 'shoot')
+    jumper_features = 5
+    platform_features = 5
+    monster_features = 3
+    shot_features = 3
+
+    def __init__(self, config: Config, platforms: int = 8, monsters: int = 2, shots: int = 2,
+                 max_steps: int | None = None, game: Game | None = None) -> None:
+        # Environments passed the same game share its display and assets, each still has a game of its own
+        self.config = config
+        self.game = Game(config, headless=True, shared=game)
+        self.state = None
+
+        self.platforms = platforms
+        self.monsters = monsters
+        self.shots = shots
+        self.max_steps = max_steps
+        self.steps = 0
+
+        self.width = self.config.config['screen']['width']
+        self.height = self.config.config['screen']['height']
+        self.delta_time = 1000 / self.config.config['screen']['fps']
+        self.observation_size = self.jumper_features + self.platforms * self.platform_features + \
+            self.monsters * self.monster_features + self.shots * self.shot_features
+
+    def reset(self, seed=None) -> tuple:
+        self.game.delta_time = self.delta_time
+        self.game.ticks = 0  # Timers compare accumulated floats, restart the clock to replay runs exactly
+        self.state = self.game.states.switch(MainGameState, seed=seed)
+        self.steps = 0
+        return self.observation(), {'points': self.state.points}
+
+    def step(self, action: int) -> tuple:
+        state = self.state
+        points = state.points
+        terminated = self.advance(action)
+        truncated = not terminated and self.max_steps is not None and self.steps >= self.max_steps
+        return self.observation(), state.points - points, terminated, truncated, {'points': state.points}
+
+    def advance(self, action: int) -> bool:
+        # One simulation step without building an observation, True once the run is over
+        state = self.state
+        jumper = state.jumper
+
+        if action == 1:
+            state.keystroke_left()
+        elif action == 2:
+            state.keystroke_right()
+        else:
+            jumper.speed_x = 0
+            target = self.shoot_target() if action == 3 else None
+            if target is not None:
+                state.keystroke_shoot(target)
+
+        self.game.delta_time = self.delta_time
+        self.game.update()
+        self.steps += 1
+        return self.game.state is not state
+
+    def shoot_target(self) -> pygame.Vector2 | None:
+        # Shooting without a monster to aim at does nothing
+        jumper = self.state.jumper
+        monsters = self.state.monsters.sprites()
+        if not monsters:
+            return None
+        target = min(monsters, key=lambda monster: jumper.position.distance_squared_to((monster.x, monster.y)))
+        return pygame.Vector2(target.x, target.y)
+
+    def nearest(self, sprites: list, count: int) -> list:
+        jumper = self.state.jumper
+        return sorted(sprites, key=lambda sprite: abs(sprite.rect.centery - jumper.rect.bottom))[:count]
+
+    def observation(self) -> list:
+        # Positions are relative to the jumper and normalized by the screen size
+        jumper = self.state.jumper
+        move_x_speed = self.config.config['main_game']['jumper']['move_x_speed']
+        observation = [
+            jumper.rect.centerx / self.width,
+            jumper.rect.bottom / self.height,
+            float(jumper.jumping),
+            jumper.jump_offset / jumper.profile.rise_time,
+            jumper.speed_x / move_x_speed
+        ]
+
+        platforms = self.nearest(self.state.platforms.sprites(), self.platforms)
+        for platform in platforms:
+            observation += [
+                (platform.rect.centerx - jumper.rect.centerx) / self.width,
+                (platform.rect.top - jumper.rect.bottom) / self.height,
+                Snapshot.platform_types.index(type(platform)) / (len(Snapshot.platform_types) - 1),
+                float(platform.bouncable),
+                platform.moving_direction * platform.moving_speed
+            ]
+        observation += [0.0] * ((self.platforms - len(platforms)) * self.platform_features)
+
+        for sprites, count in ((self.state.monsters.sprites(), self.monsters), (self.state.shots.sprites(), self.shots)):
+            sprites = self.nearest(sprites, count)
+            for sprite in sprites:
+                observation += [
+                    (sprite.rect.centerx - jumper.rect.centerx) / self.width,
+                    (sprite.rect.centery - jumper.rect.centery) / self.height,
+                    1.0
+                ]
+            observation += [0.0] * ((count - len(sprites)) * 3)
+
+        return observation
+
+
+class VectorDoodleJumpEnv:
+    # Steps a batch of environments, finished environments are reset automatically
+    def __init__(self, config: Config, count: int, **kwargs) -> None:
+        # One headless game provides the display and assets, the environments only bring their own states
+        self.game = Game(config, headless=True)
+        self.envs = [DoodleJumpEnv(config, game=self.game, **kwargs) for _ in range(count)]
+        self.seeds = [None] * count
+
+    def reset(self, seed=None) -> tuple:
+        self.seeds = [None if seed is None else seed + i for i in range(len(self.envs))]
+        results = [env.reset(env_seed) for env, env_seed in zip(self.envs, self.seeds)]
+        return [observation for observation, _ in results], [info for _, info in results]
+
+    def step(self, actions: list) -> tuple:
+        observations, rewards, terminated, truncated, infos = [], [], [], [], []
+        for i, (env, action) in enumerate(zip(self.envs, actions)):
+            observation, reward, env_terminated, env_truncated, info = env.step(action)
+            if env_terminated or env_truncated:
+                info['final_observation'] = observation
+                if self.seeds[i] is not None:
+                    self.seeds[i] += len(self.envs)
+                observation, _ = env.reset(self.seeds[i])
+
+            observations.append(observation)
+            rewards.append(reward)
+            terminated.append(env_terminated)
+            truncated.append(env_truncated)
+            infos.append(info)
+        return observations, rewards, terminated, truncated, infos
+
+
+class RaceTrack:
+    # Platform stream shared by the players of a race, extended by whoever climbs past its end first
+    def __init__(self) -> None:
+        self.entries = []  # Platform type, x, world y, moving speed and monster type of every spawned platform
+
+    def next_platform(self, state: MainGameState) -> tuple:
+        index = state.track_index
+        state.track_index += 1
+        if index == len(self.entries):
+            platform, monster = state.spawn_platform()
+            self.entries.append((type(platform), platform.rect.x, platform.rect.y - state.vp_offset,
+                                 platform.moving_speed, None if monster is None else type(monster)))
+            return platform, monster
+
+        # World y stays fixed, the screen position depends on how far this player scrolled
+        platform_type, x, world_y, moving_speed, monster_type = self.entries[index]
+        platform = platform_type(state.config, state.game,
+                                 state.config.config['main_game']['platform']['width'],
+                                 state.config.config['main_game']['platform']['height'],
+                                 x,
+                                 state.config.config['screen']['height'] - world_y - state.vp_offset,
+                                 state.random)
+        platform.moving_speed = moving_speed
+
+        monster = None
+        if monster_type is not None:
+            monster = monster_type(state.config, state.game, platform.rect.centerx, platform.rect.centery)
+        return platform, monster
+
+
+class RaceProtocol:
+    # Length prefixed messages, JSON while joining and finishing, binary for the per tick traffic
+    frame = struct.Struct('<IB')  # payload length, message type
+    max_payload = 65536
+    hello, start, tick_input, update, end = range(1, 6)
+
+    input_record = struct.Struct('<IB')  # tick, action
+    update_header = struct.Struct('<IIiiHHB')  # tick, points, jumper x, jumper world y, changed, removed, players
+    entity_record = struct.Struct('<HBii')  # network id, kind, x, world y
+    removed_record = struct.Struct('<H')  # network id
+    player_record = struct.Struct('<BIi?')  # player, points, jumper world y, alive
+
+    # Kind is the index in entity_types, with the broken flag for platforms which can't be bounced on anymore
+    entity_types = Snapshot.platform_types + Snapshot.monster_types + Snapshot.ball_types
+    kinds = {entity_type: index for index, entity_type in enumerate(entity_types)}
+    broken = 0x80
+
+    @classmethod
+    def pack(cls, message_type: int, payload: bytes) -> bytes:
+        return cls.frame.pack(len(payload), message_type) + payload
+
+    @classmethod
+    def pack_json(cls, message_type: int, data: dict) -> bytes:
+        return cls.pack(message_type, json.dumps(data).encode())
+
+    @classmethod
+    def unpack(cls, received: bytearray) -> list:
+        # Complete messages are removed from received, a partial one stays for the next read
+        messages = []
+        offset = 0
+        while len(received) - offset >= cls.frame.size:
+            length, message_type = cls.frame.unpack_from(received, offset)
+            if length > cls.max_payload:
+                raise ValueError(f'Message of {length} bytes is too long')
+            end = offset + cls.frame.size + length
+            if len(received) < end:
+                break
+            messages.append((message_type, bytes(received[offset + cls.frame.size:end])))
+            offset = end
+        del received[:offset]
+        return messages
+
+
+class RaceConnection:
+    # Non-blocking client socket of the server with its partial input and pending output
+    def __init__(self, sock) -> None:
+        self.socket = sock
+        self.received = bytearray()
+        self.pending = bytearray()
+        self.writing = False  # Registered for EVENT_WRITE while pending doesn't fit into the socket buffer
+        self.closing = False  # Write side shut down once pending is sent
+        self.shut = 0.0  # Time of the shutdown, closed when the client hangs up or after close_timeout
+        self.player = None
+
+    def send(self, data: bytes) -> None:
+        self.pending += data
+
+
+class RacePlayer:
+    # Server side of one client: its simulation, inputs and the entities it was last sent
+    def __init__(self, connection: RaceConnection, name: str) -> None:
+        self.connection = connection
+        self.name = name
+        self.index = 0
+        self.env = None
+        self.match = None
+
+        self.inputs = {}  # Tick to action, sent input_delay ticks ahead
+        self.action = 0  # Used again when the input of a tick arrives too late
+        self.missed = 0  # Ticks in a row without the input in time, the match stops waiting after max_missed_inputs
+        self.alive = True
+        self.finished = None  # Tick on which finish_points were reached
+
+        self.ids = {}  # Sprite to network id
+        self.next_id = 0
+        self.sent = {}  # Network id to the record the client has
+
+    @property
+    def playing(self) -> bool:
+        return self.alive and self.finished is None and self.connection is not None
+
+    def records(self) -> dict:
+        state = self.env.state
+        vp_offset = int(state.vp_offset)
+        records = {}
+        ids = {}
+        for group in (state.platforms, state.monsters, state.shots, state.jumper.shots):
+            for sprite in group:
+                network_id = self.ids.get(sprite)
+                if network_id is None:
+                    network_id = self.next_id
+                    self.next_id = (self.next_id + 1) % 65536
+                ids[sprite] = network_id
+
+                kind = RaceProtocol.kinds[type(sprite)]
+                if isinstance(sprite, Platform) and not sprite.bouncable:
+                    kind |= RaceProtocol.broken
+                records[network_id] = (kind, sprite.rect.x, sprite.rect.y - vp_offset)
+        self.ids = ids  # Drops the sprites which are gone
+        return records
+
+    def delta(self, tick: int, players: bytes, player_count: int) -> tuple:
+        # Only entities which are new or changed since the last update, and the ids of removed ones
+        state = self.env.state
+        records = self.records()
+        changed = [(network_id, *record) for network_id, record in records.items()
+                   if self.sent.get(network_id) != record]
+        removed = [network_id for network_id in self.sent if network_id not in records]
+        self.sent = records
+
+        jumper = state.jumper
+        parts = [RaceProtocol.update_header.pack(tick, int(state.points), jumper.rect.x,
+                                                 jumper.rect.y - int(state.vp_offset), len(changed), len(removed),
+                                                 player_count)]
+        parts += [RaceProtocol.entity_record.pack(*record) for record in changed]
+        parts += [RaceProtocol.removed_record.pack(network_id) for network_id in removed]
+        parts.append(players)
+        payload = b''.join(parts)
+
+        # Size of the same update with every entity in it, for the compression metric
+        full_size = RaceProtocol.update_header.size + len(records) * RaceProtocol.entity_record.size + len(players)
+        return payload, full_size
+
+
+class RaceMatch:
+    # Players racing on one seeded track, a tick is simulated once every playing player sent its input
+    def __init__(self, config: Config, game: Game, number: int, players: list, seed: int) -> None:
+        self.config = config
+        self.settings = self.config.config['race']
+        self.number = number
+        self.players = players
+        self.seed = seed
+        self.track = RaceTrack()
+
+        self.tick = 0
+        self.finished = False
+        self.late_inputs = 0
+        self.bytes_sent = 0
+        self.bytes_full = 0
+
+        names = [player.name for player in self.players]
+        for index, player in enumerate(self.players):
+            player.index = index
+            player.match = self
+            player.env = DoodleJumpEnv(config, game=game)
+            player.env.game.states.get(MainGameState).track = self.track
+            player.env.reset(seed)
+            player.connection.send(RaceProtocol.pack_json(RaceProtocol.start, {
+                'match': self.number,
+                'seed': seed,
+                'player': index,
+                'players': names,
+                'tick_rate': self.settings['tick_rate'],
+                'input_delay': self.settings['input_delay']
+            }))
+
+        self.started = time.perf_counter()
+        self.tick_started = self.started
+
+    def tick_time(self) -> float:
+        # Earliest time the current tick may be simulated
+        if self.settings['realtime']:
+            return self.started + self.tick / self.settings['tick_rate']
+        return 0.0
+
+    def deadline(self) -> float:
+        if all(self.tick in player.inputs for player in self.players
+               if player.playing and player.missed < self.settings['max_missed_inputs']):
+            return self.tick_time()
+        return max(self.tick_time(), self.tick_started + self.settings['input_timeout'])
+
+    def ready(self, now: float) -> bool:
+        return not self.finished and now >= self.deadline()
+
+    def step(self, now: float) -> None:
+        for player in self.players:
+            if not player.playing:
+                player.inputs.clear()
+                continue
+
+            action = player.inputs.pop(self.tick, None)
+            if action is None:
+                self.late_inputs += 1
+                player.missed += 1
+                action = player.action
+            else:
+                player.missed = 0
+            player.action = action if action != 3 else 0  # Keep moving, but don't keep shooting
+
+            if player.env.advance(action):
+                player.alive = False
+            elif player.env.state.points >= self.settings['finish_points']:
+                player.finished = self.tick
+
+        players = b''.join(RaceProtocol.player_record.pack(player.index, int(player.env.state.points),
+                                                           player.env.state.jumper.rect.y -
+                                                           int(player.env.state.vp_offset), player.alive)
+                           for player in self.players)
+        for player in self.players:
+            if player.connection is None:
+                continue
+            payload, full_size = player.delta(self.tick, players, len(self.players))
+            player.connection.send(RaceProtocol.pack(RaceProtocol.update, payload))
+            self.bytes_sent += len(payload)
+            self.bytes_full += full_size
+
+        self.tick += 1
+        self.tick_started = now
+        if self.tick >= self.settings['max_ticks'] or not any(player.playing for player in self.players):
+            self.finish()
+
+    def ranking(self) -> list:
+        # Finishers by their finishing tick, everyone else by points
+        players = sorted(self.players, key=lambda player: (player.finished is None, player.finished or 0,
+                                                           -player.env.state.points))
+        return [{
+            'player': player.index,
+            'name': player.name,
+            'points': round(player.env.state.points),
+            'finished': player.finished,
+            'alive': player.alive
+        } for player in players]
+
+    def finish(self) -> None:
+        self.finished = True
+        end = RaceProtocol.pack_json(RaceProtocol.end, {'match': self.number, 'ticks': self.tick,
+                                                         'ranking': self.ranking()})
+        for player in self.players:
+            if player.connection is not None:
+                player.connection.send(end)
+                player.connection.closing = True
+
+
+class RaceServer:
+    # Authoritative and headless, one selector loop serves the lobby and every running match
+    def __init__(self, config: Config, host: str | None = None, port: int | None = None,
+                 max_matches: int | None = None) -> None:
+        self.config = config
+        self.settings = self.config.config['race']
+
+        self.selector = selectors.DefaultSelector()
+        self.listener = socket.create_server((host or self.settings['host'],
+                                              self.settings['port'] if port is None else port))
+        self.listener.setblocking(False)
+        self.selector.register(self.listener, selectors.EVENT_READ)
+        self.address = self.listener.getsockname()
+        self.game = Game(config, headless=True)  # Display and assets shared by every player's game
+
+        self.connections = set()
+        self.lobby = []
+        self.lobby_started = 0.0
+        self.matches = []
+        self.max_matches = max_matches
+        self.running = True
+
+        self.played = 0
+        self.ticks = 0
+        self.step_time = 0.0
+        self.late_inputs = 0
+        self.bytes_sent = 0
+        self.bytes_full = 0
+
+    def serve_forever(self) -> None:
+        # Once stopped, the loop only runs until the clients of the last matches have hung up
+        while self.running or any(connection.closing for connection in self.connections):
+            for key, events in self.selector.select(self.timeout()):
+                if key.fileobj is self.listener:
+                    self.accept()
+                    continue
+                if events & selectors.EVENT_READ:
+                    self.receive(key.data)
+                if events & selectors.EVENT_WRITE:
+                    self.flush(key.data)
+
+            now = time.perf_counter()
+            if self.running:
+                self.start_matches(now)
+            for match in self.matches:
+                if match.ready(now):
+                    step_start = time.perf_counter()
+                    try:
+                        match.step(now)
+                    except Exception as e:
+                        # Only the broken match ends, the other matches carry on
+                        print(f'Ending race match {match.number}: {e!r}')
+                        match.finish()
+                        continue
+                    self.step_time += time.perf_counter() - step_start
+                    self.ticks += 1
+            for match in [match for match in self.matches if match.finished]:
+                self.end_match(match)
+
+            for connection in list(self.connections):
+                if connection.pending and not connection.writing:
+                    self.flush(connection)
+                elif connection.shut and now - connection.shut >= self.settings['close_timeout']:
+                    self.disconnect(connection)
+        self.close()
+
+    def timeout(self) -> float | None:
+        deadlines = [match.deadline() for match in self.matches]
+        deadlines += [connection.shut + self.settings['close_timeout']
+                      for connection in self.connections if connection.shut]
+        if self.lobby:
+            deadlines.append(self.lobby_started + self.settings['lobby_timeout'])
+        if not deadlines:
+            return None
+        return max(0.0, min(deadlines) - time.perf_counter())
+
+    def accept(self) -> None:
+        try:
+            sock, _ = self.listener.accept()
+        except BlockingIOError:
+            return
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # Lockstep can't wait for Nagle
+        connection = RaceConnection(sock)
+        self.connections.add(connection)
+        self.selector.register(sock, selectors.EVENT_READ, connection)
+
+    def receive(self, connection: RaceConnection) -> None:
+        try:
+            data = connection.socket.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self.disconnect(connection)
+            return
+
+        connection.received += data
+        try:
+            for message_type, payload in RaceProtocol.unpack(connection.received):
+                self.handle(connection, message_type, payload)
+        except (ValueError, struct.error) as e:
+            # Only the client which broke the protocol is dropped, the other matches carry on
+            print(f'Dropping race client: {e}')
+            self.disconnect(connection)
+
+    def handle(self, connection: RaceConnection, message_type: int, payload: bytes) -> None:
+        player = connection.player
+        if message_type == RaceProtocol.tick_input and player is not None:
+            tick, action = RaceProtocol.input_record.unpack(payload)
+            if action >= len(DoodleJumpEnv.actions):
+                raise ValueError(f'Unknown action {action}')
+
+            # Inputs for simulated ticks or too far ahead are dropped, nothing piles up for a whole match
+            match = player.match
+            if match is not None and not match.finished and player.playing and \
+                    match.tick <= tick < match.tick + self.settings['input_delay'] + self.settings['input_window']:
+                player.inputs[tick] = action
+        elif message_type == RaceProtocol.hello and player is None:
+            hello = json.loads(payload)
+            if not isinstance(hello, dict) or not isinstance(hello.get('name', ''), str):
+                raise ValueError('Malformed hello')
+            connection.player = RacePlayer(connection, hello.get('name', 'player')[:32])
+            if not self.lobby:
+                self.lobby_started = time.perf_counter()
+            self.lobby.append(connection.player)
+        else:
+            raise ValueError(f'Unexpected message type {message_type}')
+
+    def flush(self, connection: RaceConnection) -> None:
+        try:
+            sent = connection.socket.send(connection.pending)
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            self.disconnect(connection)
+            return
+        del connection.pending[:sent]
+
+        if connection.closing and not connection.pending and not connection.shut:
+            # Closing right away would reset the client while it still answers the last updates
+            try:
+                connection.socket.shutdown(socket.SHUT_WR)
+            except OSError:
+                self.disconnect(connection)
+                return
+            connection.shut = time.perf_counter()
+        if bool(connection.pending) != connection.writing:
+            connection.writing = bool(connection.pending)
+            events = selectors.EVENT_READ | (selectors.EVENT_WRITE if connection.writing else 0)
+            self.selector.modify(connection.socket, events, connection)
+
+    def disconnect(self, connection: RaceConnection) -> None:
+        if connection not in self.connections:
+            return
+        self.connections.remove(connection)
+        self.selector.unregister(connection.socket)
+        connection.socket.close()
+
+        player = connection.player
+        if player is not None:
+            player.connection = None  # A running match treats the player as out of the race
+            if player in self.lobby:
+                self.lobby.remove(player)
+
+    def start_matches(self, now: float) -> None:
+        players = self.settings['players']
+        while len(self.lobby) >= players or (self.lobby and now - self.lobby_started >= self.settings['lobby_timeout']):
+            seed = self.settings['seed']
+            if seed is None:
+                seed = random.randrange(2 ** 32)
+            self.matches.append(RaceMatch(self.config, self.game, self.played + len(self.matches), self.lobby[:players], seed))
+            self.lobby = self.lobby[players:]
+            self.lobby_started = now
+
+    def end_match(self, match: RaceMatch) -> None:
+        self.matches.remove(match)
+        self.played += 1
+        self.late_inputs += match.late_inputs
+        self.bytes_sent += match.bytes_sent
+        self.bytes_full += match.bytes_full
+        if self.max_matches is not None and self.played >= self.max_matches:
+            self.running = False
+
+    def close(self) -> None:
+        for connection in list(self.connections):
+            if connection.pending:
+                connection.socket.setblocking(True)
+                try:
+                    connection.socket.sendall(connection.pending)
+                except OSError:
+                    pass
+            self.disconnect(connection)
+        self.selector.unregister(self.listener)
+        self.listener.close()
+        self.selector.close()
+
+    def report(self) -> dict:
+        return {
+            'matches': self.played,
+            'ticks': self.ticks,
+            'mean_tick_ms': round(self.step_time / self.ticks * 1000, 3) if self.ticks else 0.0,
+            'late_inputs': self.late_inputs,
+            'bytes_sent': self.bytes_sent,
+            'bytes_without_delta': self.bytes_full,
+            'delta_ratio': round(self.bytes_sent / self.bytes_full, 3) if self.bytes_full else 0.0
+        }
+
+
+class RaceClient:
+    # Sends an input for every tick and rebuilds the own world from the delta updates
+    def __init__(self, config: Config, name: str, host: str | None = None, port: int | None = None) -> None:
+        self.config = config
+        self.settings = self.config.config['race']
+        self.name = name
+
+        self.socket = socket.create_connection((host or self.settings['host'],
+                                                self.settings['port'] if port is None else port))
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.received = bytearray()
+
+        self.start = None
+        self.result = None
+        self.tick = -1
+        self.points = 0
+        self.jumper = (0, 0)  # x and world y
+        self.entities = {}  # Network id to (kind, x, world y)
+        self.players = {}  # Player to (points, jumper world y, alive)
+
+    def send(self, message_type: int, payload: bytes) -> None:
+        self.socket.sendall(RaceProtocol.pack(message_type, payload))
+
+    def messages(self):
+        while True:
+            data = self.socket.recv(65536)
+            if not data:
+                return
+            self.received += data
+            yield from RaceProtocol.unpack(self.received)
+
+    def run(self) -> dict | None:
+        self.send(RaceProtocol.hello, json.dumps({'name': self.name}).encode())
+        try:
+            for message_type, payload in self.messages():
+                if message_type == RaceProtocol.start:
+                    self.start = json.loads(payload)
+                    for tick in range(self.start['input_delay']):
+                        self.send(RaceProtocol.tick_input, RaceProtocol.input_record.pack(tick, 0))
+                elif message_type == RaceProtocol.update:
+                    self.apply(payload)
+                    self.send(RaceProtocol.tick_input,
+                              RaceProtocol.input_record.pack(self.tick + self.start['input_delay'], self.act()))
+                elif message_type == RaceProtocol.end:
+                    self.result = json.loads(payload)
+                    break
+        except ConnectionError:
+            pass  # The server is gone, the match ended without a result
+        finally:
+            self.socket.close()
+        return self.result
+
+    def apply(self, payload: bytes) -> None:
+        self.tick, self.points, x, y, changed, removed, players = RaceProtocol.update_header.unpack_from(payload, 0)
+        self.jumper = (x, y)
+        offset = RaceProtocol.update_header.size
+
+        for network_id, *record in RaceProtocol.entity_record.iter_unpack(
+                payload[offset:offset + changed * RaceProtocol.entity_record.size]):
+            self.entities[network_id] = tuple(record)
+        offset += changed * RaceProtocol.entity_record.size
+
+        for network_id, in RaceProtocol.removed_record.iter_unpack(
+                payload[offset:offset + removed * RaceProtocol.removed_record.size]):
+            del self.entities[network_id]
+        offset += removed * RaceProtocol.removed_record.size
+
+        for player, *record in RaceProtocol.player_record.iter_unpack(payload[offset:]):
+            self.players[player] = tuple(record)
+
+    def act(self) -> int:
+        return 0
+
+
+class RaceBot(RaceClient):
+    # Steers towards the highest platform it can still land on and shoots at monsters close above
+    def __init__(self, config: Config, name: str, host: str | None = None, port: int | None = None) -> None:
+        super().__init__(config, name, host, port)
+
+        self.width = self.config.config['screen']['width']
+        self.jumper_width = self.config.config['main_game']['jumper']['width']
+        self.jumper_height = self.config.config['main_game']['jumper']['height']
+        self.platform_width = self.config.config['main_game']['platform']['width']
+        self.platform_types = len(Snapshot.platform_types)
+        self.monster_kinds = range(self.platform_types, self.platform_types + len(Snapshot.monster_types))
+        self.profile = JumpProfile(self.config)
+        self.aim = random.Random(name).uniform(-20, 20)  # Bots of one match don't play identically
+        self.last_y = 0
+
+    def act(self) -> int:
+        x = self.jumper[0] + self.jumper_width / 2
+        feet = self.jumper[1] + self.jumper_height
+        falling = self.jumper[1] > self.last_y
+        self.last_y = self.jumper[1]
+
+        for kind, _, y in self.entities.values():
+            if kind in self.monster_kinds and 0 < feet - y < 300 and self.tick % 15 == 0:
+                return 3
+
+        # Falling, only platforms below the feet can be landed on, rising the next jump may go higher
+        platforms = []
+        for kind, platform_x, y in self.entities.values():
+            platform_x += self.platform_width / 2 + self.aim
+            if kind >= self.platform_types or (falling and y < feet - 10):
+                continue
+            if not falling and not self.profile.can_reach(platform_x - x, feet - y):
+                continue
+            platforms.append((platform_x, y))
+        if not platforms:
+            return 0
+        target_x, _ = min(platforms, key=lambda platform: platform[1])
+
+        # Shortest way, the jumper wraps around the screen edges
+        distance = (target_x - x + self.width / 2) % self.width - self.width / 2
+        if abs(distance) < 8:
+            return 0
+        return 2 if distance > 0 else 1
+
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Doodle Jump')
+    subparsers = parser.add_subparsers(dest='command')
+    telemetry_parser = subparsers.add_parser('telemetry', help='aggregate recorded telemetry files')
+    telemetry_parser.add_argument('directory', nargs='?', help='defaults to telemetry.directory from the config')
+    race_server_parser = subparsers.add_parser('race-server', help='host headless multiplayer races')
+    race_server_parser.add_argument('--host', help='defaults to race.host from the config')
+    race_server_parser.add_argument('--port', type=int, help='defaults to race.port from the config')
+    race_server_parser.add_argument('--matches', type=int, help='stop after this many matches')
+    race_bots_parser = subparsers.add_parser('race-bots', help='join a race server with bot clients')
+    race_bots_parser.add_argument('--host', help='defaults to race.host from the config')
+    race_bots_parser.add_argument('--port', type=int, help='defaults to race.port from the config')
+    race_bots_parser.add_argument('--count', type=int, help='defaults to race.players from the config')
+    args = parser.parse_args()
+
     config = Config()
-    game = Game(config)
-    game.run()
+    if args.command == 'telemetry':
+        directory = args.directory or os.path.join(Path.runtime_path, config.config['telemetry']['directory'])
+        print(json.dumps(Telemetry.analyze(directory), indent=4))
+    elif args.command == 'race-server':
+        server = RaceServer(config, args.host, args.port, args.matches)
+        print(f'Race server listening on {server.address[0]}:{server.address[1]}')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.close()
+        print(json.dumps(server.report(), indent=4))
+    elif args.command == 'race-bots':
+        bots = [RaceBot(config, f'bot-{i}', args.host, args.port)
+                for i in range(args.count or config.config['race']['players'])]
+        results = [None] * len(bots)
+
+        def run_bot(index):
+            results[index] = bots[index].run()
+
+        threads = [threading.Thread(target=run_bot, args=(index,)) for index in range(len(bots))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        print(json.dumps(results, indent=4))
+    else:
+        game = Game(config)
+        game.run()